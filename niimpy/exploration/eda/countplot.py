@@ -28,12 +28,12 @@ def get_counts(df,aggregation):
     assert isinstance(aggregation,str), "aggregation is not a string"
     
     if aggregation == 'group':
-            n_events = df[['group', 'user']].groupby(['group']).size().to_frame()
+            n_events = df[['group', 'user']].groupby(['group'], observed=True).size().to_frame()
             n_events.columns = ['values']
             n_events = n_events.reset_index()
             
     elif aggregation == 'user':
-            n_events = df[['user']].groupby(['user']).size().to_frame()
+            n_events = df[['user']].groupby(['user'], observed=True).size().to_frame()
             n_events.columns = ['values']
             n_events = n_events.reset_index()
     
@@ -83,9 +83,9 @@ def calculate_averages_(df,column, by):
     """
     
     if by == 'hour':
-        averages = df[[column,'group']].groupby([df.index.hour,'group']).mean().reset_index()
+        averages = df[[column,'group']].groupby([df.index.hour,'group'], observed=True).mean().reset_index()
     elif by == 'weekday':
-        averages = df[[column, 'group']].groupby([df.index.weekday, 'group']).mean().reset_index()
+        averages = df[[column, 'group']].groupby([df.index.weekday, 'group'], observed=True).mean().reset_index()
     else:
         averages = 0
     
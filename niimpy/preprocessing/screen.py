@@ -42,7 +42,7 @@ def util_screen(df, bat=None, screen_column_name = "screen_status", **kwargs):
         
         if not shutdown.empty:
             df = pd.concat([df, shutdown])
-            df.fillna(0, inplace=True)
+            util.fillna_data(df, 0)
             df = df[id_columns + [screen_column_name]]
 
     #Sort the dataframe
@@ -56,7 +56,7 @@ def util_screen(df, bat=None, screen_column_name = "screen_status", **kwargs):
     df['missing'] = np.where(df['dummy']==0, 1, 0) #Check the missing points and label them as 1
     df['missing'] = df['missing'].shift(1)
     df.drop(['dummy','next'], axis=1, inplace=True)
-    df.fillna(0, inplace=True)
+    util.fillna_data(df, 0)
    
     df = df[df.missing == 0] #Discard missing values
     df.drop(["missing"], axis=1, inplace=True)
@@ -100,7 +100,7 @@ def event_classification_screen(df, screen_column_name = "screen_status", **kwar
     
     index_name = df.index.name
     df.reset_index(inplace=True)
-    df = df.groupby(["device"]).apply(lambda x: x.iloc[:-1], include_groups=False) 
+    df = df.groupby(["device"], observed=True).apply(lambda x: x.iloc[:-1], include_groups=False) 
     
     df["use"] =  df["on"] = df["na"] = df["off"] = 0
     df.loc[(df.next=='30') | (df.next=='31') | (df.next=='32'), "use"]=1 #in use
@@ -112,8 +112,8 @@ def event_classification_screen(df, screen_column_name = "screen_status", **kwar
     
     #Discard the first and last row because they do not have all info. We do not
     #know what happened before or after these points.
-    df = df.groupby(["device"], group_keys=False).apply(lambda x: x.iloc[1:], include_groups=False)
-    df = df.groupby(["device"], group_keys=False).apply(lambda x: x.iloc[:-1], include_groups=False)
+    df = df.groupby(["device"], group_keys=False, observed=True).apply(lambda x: x.iloc[1:], include_groups=False)
+    df = df.groupby(["device"], group_keys=False, observed=True).apply(lambda x: x.iloc[:-1], include_groups=False)
     df.reset_index(["device"], inplace=True)
     
     # Set the original index. If the origianal name was none, the 
@@ -96,7 +96,7 @@ def uninstall_extensions():
     unlink_if_exists(SQLITE3_EXTENSIONS_FILENAME)
 
 
-def read_preprocess(df, add_group=None):
+def read_preprocess(df, add_group=None, add_user=None, categorical_ids=False):
     """Standard preprocessing arguments when reading.
 
     This is a preprocessing filter which handles some standard arguments
@@ -116,6 +116,18 @@ def read_preprocess(df, add_group=None):
         If given, add a new 'group' column with all values set to this
         given identifier.
 
+    add_user: string, optional
+
+        If given, add a new 'user' column with all values set to this
+        given identifier.  This is useful for data where each user is
+        stored in a separate file.
+
+    categorical_ids: bool, optional
+
+        If true, store the identifier columns (user, device, group) as
+        pandas categoricals.  Each identifier is then stored once, and
+        grouping uses the integer codes instead of hashing strings.
+
 
     Returns
     -------
@@ -126,10 +138,22 @@ def read_preprocess(df, add_group=None):
         be a copy)
 
     """
+    if add_user is not None:
+        df['user'] = add_user
     if add_group is not None:
         df['group'] = add_group
-        #df['group'] = df['group'].astype('category')
-        #pd.Categorical(add_group)
+    if categorical_ids:
+        df = categorical_identifiers(df)
+    return df
+
+
+def categorical_identifiers(df, id_columns=["user", "device", "group"]):
+    """ Convert the identifier columns present in the dataframe to pandas
+    categoricals.  Columns which already are categorical are kept as-is.
+    """
+    for column in identifier_columns(df, id_columns):
+        if not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
     return df
 
 
@@ -147,7 +171,12 @@ def df_normalize(df, tz=None, old_tz=None):
         df.index.name = None
         df['datetime'] = df.index
     elif 'day' in df and 'hour' in df:
-        index = df[['day', 'hour']].apply(lambda row: pd.Timestamp('%s %s:00'%(row['day'], row['hour'])), axis=1)
+        # Vectorized: parse the days once, and add the hours as timedeltas
+        try:
+            day = pd.to_datetime(df['day'], format='%Y-%m-%d')
+        except ValueError:
+            day = pd.to_datetime(df['day'])
+        index = day + pd.to_timedelta(df['hour'].astype('int64'), unit='h')
         if old_tz is not None:
             # old_tz is given - e.g. sqlite already converts it to localtime
             index = index.dt.tz_localize(old_tz).dt.tz_convert(tz)
@@ -189,7 +218,24 @@ def group_data(df, additional_columns=None, id_columns=["user", "device", "group
     elif additional_columns is None:
         additional_columns = []
     columns = identifier_columns(df, id_columns + additional_columns)
-    return df.groupby(columns)
+    # observed=True: with categorical identifiers, only groups that are
+    # present in the data are returned (not all combinations of categories)
+    return df.groupby(columns, observed=True)
+
+
+def fillna_data(df, value):
+    """ Fill missing values in place, as df.fillna(value, inplace=True).
+    Categorical columns (such as categorical identifiers) can only be
+    filled with their categories, so those with missing values are
+    filled as objects and converted back, with the categories sorted as
+    the values of an object column would be.
+    """
+    columns = df.columns[df.isna().any()]
+    for column in columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(object).fillna(value).astype('category')
+    df.fillna({column: value for column in columns}, inplace=True)
+    return df
 
 
 def reset_groups(df, additional_columns=None, id_columns = ["user", "device", "group"]):
@@ -312,7 +358,7 @@ def aggregate(df, freq, method_numerical='mean', method_categorical='first', gro
     """
 
     #Groupby user
-    groupby = df.groupby(groups)
+    groupby = df.groupby(groups, observed=True)
 
     #Resample numerical columns -> sub_df1
     assert method_numerical in ['mean', 'sum', 'median'], \
@@ -332,7 +378,7 @@ def aggregate(df, freq, method_numerical='mean', method_categorical='first', gro
     cat_cols.extend(groups)
     cat_cols = list(set(cat_cols))
 
-    groupby = df[cat_cols].groupby(groups)
+    groupby = df[cat_cols].groupby(groups, observed=True)
     assert method_categorical in ['first', 'mode', 'last']
     if method_categorical == 'first':
         sub_df2 = groupby.resample(freq, **resample_kwargs, include_groups=False).first()
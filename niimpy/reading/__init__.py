@@ -2,3 +2,5 @@ from . import mhealth
 from . import csv
 from . import google_takeout
 from . import sqlite
+from . import parquet
+from . import aware
@@ -0,0 +1,160 @@
+"""Read Aware data exports
+
+Aware exports are directories with one CSV file per sensor (table),
+possibly compressed, e.g. 'AwareScreen.csv' or
+'AwareScreen_1month.csv.gz'.  This module reads many such files in
+parallel.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import warnings
+
+import pandas as pd
+
+from niimpy.reading import csv
+from niimpy.reading import util as reading_util
+from niimpy.preprocessing import util
+
+# File name extensions of CSV files, with the compressions pandas can read
+CSV_EXTENSIONS = ('.csv', '.csv.gz', '.csv.bz2', '.csv.xz', '.csv.zip')
+
+
+def _csv_stem(filename):
+    """Return the file name without directory and CSV extension, or None
+    if this is not a CSV file."""
+    basename = os.path.basename(filename)
+    for extension in CSV_EXTENSIONS:
+        if basename.lower().endswith(extension):
+            return basename[:-len(extension)]
+    return None
+
+
+def find_sensor_files(path, sensors=None):
+    """Find the CSV files of each sensor in a directory
+
+    A file belongs to a sensor if one of the '_'-separated parts of the
+    file name (without extension) is the sensor name, compared without
+    case: 'AwareScreen_1month.csv.gz' and 'multiuser_AwareScreen.csv'
+    are both files of the sensor 'AwareScreen'.  Subdirectories are
+    searched too.
+
+    Parameters
+    ----------
+
+    path : str
+        Directory name
+
+    sensors : list of str, optional
+        Sensor names.  If not given, each file is its own sensor, named
+        by the file name without extension.
+
+    Returns
+    -------
+
+    files : dict
+        sensor name -> sorted list of filenames.  Sensors without files
+        are not included.
+    """
+    files = { }
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            stem = _csv_stem(filename)
+            if stem is None:
+                continue
+            filename = os.path.join(dirpath, filename)
+            if sensors is None:
+                files.setdefault(stem, [ ]).append(filename)
+                continue
+            parts = {part.lower() for part in stem.split('_')}
+            for sensor in sensors:
+                if sensor.lower() in parts:
+                    files.setdefault(sensor, [ ]).append(filename)
+    return files
+
+
+def _read_sensor_file(filename, tz, dtypes, engine, add_group):
+    """Read one file for read_aware_directory (runs in a worker)."""
+    return csv.read_csv(filename, tz=tz, dtypes=dtypes, engine=engine,
+                        add_group=add_group, categorical_ids=True)
+
+
+def read_aware_directory(path, sensors=None, tz=None, add_group=None, dtypes=None,
+                         engine=None, max_workers=None, processes=True):
+    """Read an Aware export directory
+
+    All sensor files are decompressed and parsed in parallel, each one
+    is normalized like in read_csv, and files of the same sensor are
+    concatenated.  The resulting DataFrames can be given directly to the
+    feature extraction functions, e.g.::
+
+        data = niimpy.read_aware_directory('export/', ['AwareScreen', 'AwareBattery'], tz='Europe/Helsinki')
+        features = niimpy.preprocessing.screen.extract_features_screen(data['AwareScreen'], data['AwareBattery'])
+
+    Identifier columns (user, device, group) are returned as pandas
+    categoricals.
+
+    Parameters
+    ----------
+
+    path : str
+        Directory name
+
+    sensors : list of str, optional
+        Names of the sensors to read, see find_sensor_files for how
+        files are matched.  If not given, read all CSV files.
+
+    tz : str
+        Timezone of the data
+
+    add_group : object, optional
+        If given, add a 'group' column with all values set to this.
+
+    dtypes : dict, optional
+        Mapping of column name to dtype, used to parse the data directly
+        into compact types.  niimpy.reading.util.AWARE_DTYPES contains
+        types for the standard Aware columns.
+
+    engine : str, optional
+        CSV parser, as in read_csv.
+
+    max_workers : int, optional
+        Number of parallel workers.
+
+    processes : bool, optional
+        Parse in a process pool (default), or a thread pool if false.
+
+    Returns
+    -------
+
+    data : dict
+        sensor name -> pandas.DataFrame.  Sensors without files are not
+        included.
+    """
+    if tz is None:
+        warnings.warn(DeprecationWarning("From now on, you should explicitely specify timezone with e.g. tz='Europe/Helsinki'"), stacklevel=2)
+        tz = util.TZ
+    if isinstance(sensors, str):
+        sensors = [sensors]
+    files = find_sensor_files(path, sensors)
+
+    # Start the largest files first so that workers finish at about the same time
+    jobs = [(sensor, filename) for sensor, filenames in files.items() for filename in filenames]
+    jobs.sort(key=lambda job: os.path.getsize(job[1]), reverse=True)
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with Executor(max_workers=max_workers) as pool:
+        futures = {job: pool.submit(_read_sensor_file, job[1], tz, dtypes, engine, add_group)
+                   for job in jobs}
+        results = {job: future.result() for job, future in futures.items()}
+
+    data = { }
+    for sensor, filenames in files.items():
+        dfs = [results.pop((sensor, filename)) for filename in filenames]
+        if len(dfs) == 1:
+            data[sensor] = dfs[0]
+            continue
+        dfs = reading_util.union_categories(dfs)
+        data[sensor] = pd.concat(dfs)
+        del dfs
+    return data
@@ -2,6 +2,7 @@
 
 """
 
+import numpy as np
 import pandas as pd
 import warnings
 
@@ -9,7 +10,8 @@ from niimpy.preprocessing import util
 
 
 def read_csv(filename, read_csv_options={}, add_group=None,
-             tz=None):
+             tz=None, columns=None, dtypes=None, chunksize=None, engine=None,
+             categorical_ids=False):
     """Read DataFrame from csv file
 
     This will read data from a csv file and then process the result with
@@ -29,19 +31,131 @@ def read_csv(filename, read_csv_options={}, add_group=None,
     add_group : object
         If given, add a 'group' column with all values set to this.
 
+    columns : list of str, optional
+        If given, only read these columns (and time).
+
+    dtypes : dict, optional
+        Mapping of column name to dtype, used to parse the data directly
+        into compact types.  niimpy.reading.util.AWARE_DTYPES contains
+        types for the standard Aware columns.  Columns not in the data
+        are ignored.
+
+    chunksize : int, optional
+        If given, do not read the whole file at once but return an
+        iterator of normalized DataFrames with at most this many rows
+        each.  This allows processing files larger than memory.
+
+    engine : str, optional
+        CSV parser to use.  With 'pyarrow', the file is parsed with the
+        multi-threaded pyarrow CSV reader (also when streaming with
+        chunksize), and read_csv_options can not be used.
+
+    categorical_ids : bool, optional
+        If true, return the identifier columns (user, device, group) as
+        pandas categoricals, which use less memory and are faster to
+        group by.
+
     """
     if tz is None:
         warnings.warn(DeprecationWarning("From now on, you should explicitely specify timezone with e.g. tz='Europe/Helsinki'"), stacklevel=2)
 
-    df = pd.read_csv(filename, **read_csv_options)
-
+    if columns is not None:
+        if isinstance(columns, str):
+            columns = [columns]
+        columns = set(columns) | {'time'}
+
+    if engine == 'pyarrow':
+        if read_csv_options:
+            raise ValueError("read_csv_options can not be used with engine='pyarrow'")
+        if chunksize is not None:
+            return _iter_csv_pyarrow(filename, chunksize, columns, dtypes, tz, add_group, categorical_ids)
+        import pyarrow.csv
+        table = pyarrow.csv.read_csv(filename, convert_options=_arrow_convert_options(filename, columns, dtypes))
+        return _normalize_chunk(table.to_pandas(), dtypes, tz, add_group, categorical_ids)
+
+    options = { }
+    if columns is not None:
+        options['usecols'] = lambda c: c in columns
+    if dtypes:
+        options['dtype'] = dtypes
+    if engine is not None:
+        options['engine'] = engine
+    options.update(read_csv_options)
+    if chunksize is not None:
+        return _iter_csv(filename, chunksize, options, tz, add_group, categorical_ids)
+    df = pd.read_csv(filename, **options)
+    return _normalize_chunk(df, None, tz, add_group, categorical_ids)
+
+
+def _normalize_chunk(df, dtypes, tz, add_group, categorical_ids):
+    """Convert types and normalize one DataFrame read from csv."""
+    if dtypes:
+        df = df.astype({c: dtype for c, dtype in dtypes.items() if c in df})
     # df_normalize converts sets the index to time values and does other time
     # conversions.  Inplace.
     util.df_normalize(df, tz=tz)
-    df = util.read_preprocess(df, add_group=add_group)
+    df = util.read_preprocess(df, add_group=add_group, categorical_ids=categorical_ids)
     return df
 
 
+def _iter_csv(filename, chunksize, options, tz, add_group, categorical_ids):
+    """Generator behind read_csv(chunksize=...)"""
+    with pd.read_csv(filename, chunksize=chunksize, **options) as reader:
+        for df in reader:
+            yield _normalize_chunk(df, None, tz, add_group, categorical_ids)
+
+
+def _arrow_type(dtype):
+    """Arrow type to parse a column into, for a pandas dtype (None if unknown)."""
+    import pyarrow as pa
+    if str(dtype) == 'category':
+        return pa.dictionary(pa.int32(), pa.string())
+    try:
+        # Nullable pandas integers ('Int8') are parsed as plain integers
+        return pa.from_numpy_dtype(np.dtype(str(dtype).lower()))
+    except (TypeError, pa.ArrowNotImplementedError):
+        return None
+
+
+def _arrow_convert_options(filename, columns, dtypes):
+    """pyarrow ConvertOptions that select columns and set their types."""
+    import pyarrow.csv
+    options = { }
+    if columns is not None:
+        # Only select the columns which exist in the file
+        names = pyarrow.csv.open_csv(filename).schema.names
+        options['include_columns'] = [c for c in names if c in columns]
+    if dtypes:
+        types = {c: _arrow_type(dtype) for c, dtype in dtypes.items()}
+        options['column_types'] = {c: t for c, t in types.items() if t is not None}
+    return pyarrow.csv.ConvertOptions(**options)
+
+
+def _iter_csv_pyarrow(filename, chunksize, columns, dtypes, tz, add_group, categorical_ids):
+    """Generator behind read_csv(chunksize=..., engine='pyarrow')
+
+    pyarrow reads the file in blocks of bytes, which are regrouped into
+    chunks of chunksize rows."""
+    import pyarrow as pa
+    import pyarrow.csv
+    reader = pyarrow.csv.open_csv(filename, convert_options=_arrow_convert_options(filename, columns, dtypes))
+    pending = [ ]
+    n_pending = 0
+    for batch in reader:
+        pending.append(batch)
+        n_pending += batch.num_rows
+        if n_pending < chunksize:
+            continue
+        table = pa.Table.from_batches(pending)
+        while table.num_rows >= chunksize:
+            yield _normalize_chunk(table.slice(0, chunksize).to_pandas(), dtypes, tz, add_group, categorical_ids)
+            table = table.slice(chunksize)
+        pending = table.to_batches()
+        n_pending = table.num_rows
+    if n_pending:
+        yield _normalize_chunk(pa.Table.from_batches(pending, schema=reader.schema).to_pandas(), dtypes, tz, add_group, categorical_ids)
+
+
 def read_csv_string(string, tz=None):
     """Parse a string containing CSV and return dataframe
 
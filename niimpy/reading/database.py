@@ -45,14 +45,23 @@ data, including databases.
 
 from __future__ import print_function, division
 
+from collections import OrderedDict
 import datetime
+import functools
+import hashlib
+import inspect
 from math import sqrt
+from concurrent.futures import ThreadPoolExecutor
 from numbers import Number
 import os
 import sqlite3
 import sys
+import threading
+import urllib.request
+import warnings
 
 import dateutil.parser
+import numpy as np
 import pandas as pd
 
 from niimpy.preprocessing import util
@@ -69,9 +78,54 @@ class ALL:
 #    selectors.append('{0} < time'.format(x))
 #    return ' AND time<'
 
-def open(db, tz=None):
-    """Open a database and return a Data1 object"""
-    return Data1(db, tz=tz)
+def open(db, tz=None, **kwargs):
+    """Open a database and return a Data1 object
+
+    Keyword arguments are passed on to Data1."""
+    return Data1(db, tz=tz, **kwargs)
+
+
+# Size of the per-connection cache of prepared statements.  All query
+# helpers bind their values as parameters, so the SQL text only depends
+# on the shape of the query and the statements can be reused.
+STATEMENT_CACHE_SIZE = 256
+
+
+# Cache of database metadata (tables, columns, users, counts), shared by
+# all Data1 objects.  The key is the state of the file from
+# _file_state(), so that entries become invalid when the file changes.
+_metadata_cache = { }
+
+
+def _file_state(path):
+    """Identify the current version of a database file for caches.
+
+    Returns the absolute path and the modification time and size of the
+    file and of its '-wal' file (None if there is none): in WAL mode,
+    writes go to the '-wal' file and the database file itself only
+    changes at checkpoints.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    state = (path, stat.st_mtime_ns, stat.st_size)
+    try:
+        wal = os.stat(path + '-wal')
+    except FileNotFoundError:
+        return state + (None, None)
+    return state + (wal.st_mtime_ns, wal.st_size)
+
+
+def _to_timestamp(x):
+    """Convert a start/end argument to unixtime."""
+    if isinstance(x, (int, float)): return x
+    if isinstance(x, str): return dateutil.parser.parse(x).timestamp() # localtime
+    if isinstance(x, datetime.datetime): return x.timestamp()
+    raise ValueError("Unknown timestamp format: {}".format(x))
+
+
+def _is_writable(path):
+    """Return True if the database file at `path` can be modified."""
+    return os.access(path, os.W_OK) and os.access(os.path.dirname(os.path.abspath(path)), os.W_OK)
 
 
 # Online variance calculation
@@ -108,30 +162,228 @@ class sqlite3_stdev:
 
 
 
+def _grouped_mean_std(values, starts):
+    """Mean, standard deviation and count of consecutive groups of values.
+
+    This is the vectorized equivalent of the SQL avg(), stdev and
+    count() aggregates: `values` is sorted by group, and `starts`
+    gives the index of the first row of each group.  Non-numeric values
+    are ignored, and groups without any values give nan.
+    """
+    if len(starts) == 0:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)
+    valid = ~np.isnan(values)
+    n = np.add.reduceat(valid.astype(np.int64), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.add.reduceat(np.where(valid, values, 0.), starts) / n
+        deviation = np.where(valid, values - np.repeat(mean, np.diff(np.append(starts, len(values)))), 0.)
+        std = np.sqrt(np.add.reduceat(deviation*deviation, starts) / n)
+    return mean, std, n
+
+
+def _local_hours(times, tz):
+    """Divide unixtimes into the hours of a timezone.
+
+    Returns two int64 arrays: the unixtime of the start of the local
+    hour containing each time, and the local wall-clock time of each
+    time (as seconds since the epoch).  The repeated hour at the end of
+    daylight saving time gives two different hours, as they have
+    different unixtimes.
+    """
+    seconds = np.floor(times).astype(np.int64)
+    utc = pd.to_datetime(seconds, unit='s', utc=True)
+    local = utc.tz_convert(tz).tz_localize(None).asi8 // 10**9
+    offset = local - seconds
+    return local // 3600 * 3600 - offset, local
+
+
+class QueryCache:
+    """Cache of query results of Data1 objects.
+
+    Results are kept in memory, and the least recently used ones are
+    dropped when there are more than `maxsize`.  If `directory` is
+    given, results are also stored there as Parquet files, so that they
+    are available to later processes too.
+
+    Keys include the database file name, modification time and size
+    (also of the '-wal' file, see _file_state()), so results of a
+    changed database are never returned.  One cache can
+    be shared by several Data1 objects.
+    """
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest()+'.parquet')
+
+    def get(self, key):
+        """Return a copy of the cached result, or None."""
+        with self._lock:
+            df = self._data.get(key)
+            if df is not None:
+                self._data.move_to_end(key)
+        if df is None and self.directory is not None and os.path.exists(self._filename(key)):
+            df = pd.read_parquet(self._filename(key))
+            self._store(key, df)
+        with self._lock:
+            if df is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return df.copy()
+
+    def _store(self, key, df):
+        with self._lock:
+            self._data[key] = df
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def put(self, key, df):
+        """Store a copy of a result."""
+        df = df.copy()
+        self._store(key, df)
+        if self.directory is not None:
+            try:
+                df.to_parquet(self._filename(key))
+            except Exception:
+                # The disk cache is best-effort: not all data (for
+                # example columns of mixed types) can be stored as Parquet.
+                pass
+
+    def clear(self):
+        """Remove all results from memory (not from disk) and reset the statistics."""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def cache_info(self):
+        """Return a dict of cache statistics."""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._data), maxsize=self.maxsize)
+
+
+def _freeze(value):
+    """Convert an argument to a hashable, repr-stable value for cache keys."""
+    if value is ALL:
+        return 'niimpy.ALL'
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (str, int, float, type(None))):
+        return value
+    return str(value)
+
+
+def _cached_query(method):
+    """Decorator: use the query result cache of Data1, if it is enabled."""
+    signature = inspect.signature(method)
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        key = _file_state(self._path) + (str(self._tz), method.__name__,
+               tuple((name, _freeze(value)) for name, value in arguments.arguments.items() if name != 'self'))
+        df = self.cache.get(key)
+        if df is None:
+            df = method(self, *args, **kwargs)
+            self.cache.put(key, df)
+        return df
+    return wrapper
+
+
 class Data1(object):
     """Database wrapper for niimpy data.
 
     This opens a database and provides methods to do common operations.
     """
-    def __init__(self, db, tz=None):
+    def __init__(self, db, tz=None, ensure_indexes=False, read_only=False,
+                 immutable=False, mmap_size=None, cache_size=None, cache=None):
         """Open the database.
 
         Don't do anything yet, but stores the open connection object on
         self.conn for future functions to use.
+
+        If `ensure_indexes` is true, run .optimize() right away, so that
+        all per-user queries can use an index.  If it is a filename,
+        that is used as the sidecar copy for read-only databases.
+
+        Each thread gets its own connection (self.conn always refers to
+        the one of the current thread), so that one object can be used
+        for parallel reads, see .raw_many().  With `read_only`, these
+        are opened with mode=ro, and `immutable` additionally tells
+        sqlite that the file can not change, which avoids all locking.
+        `mmap_size` (bytes) and `cache_size` (sqlite pages, or KiB if
+        negative) set the corresponding pragmas on each connection.
+
+        With `cache`, the results of .raw(), .hourly() and .occurrence()
+        are cached: True uses a new in-memory QueryCache, or give a
+        QueryCache object (for example to cache on disk, or to share a
+        cache).  Statistics are available from self.cache.cache_info().
         """
         if not os.path.exists(db):
             raise FileNotFoundError("Database does not exist: {}".format(db))
-        self.conn = sqlite3.connect(db)
+        self._db = db
+        self._read_only = read_only or immutable
+        self._immutable = immutable
+        self._mmap_size = mmap_size
+        self._cache_size = cache_size
+        self._connect(db)
+        self._singleuser = self._is_single_user()
+        self._tz = tz
+        self.cache = QueryCache() if cache is True else (cache or None)
+        if ensure_indexes:
+            self.optimize(sidecar=ensure_indexes if isinstance(ensure_indexes, str) else True)
+
+    def _connect(self, db):
+        """Use the given database file for all future connections.
+
+        Connections of all threads are re-opened on next use."""
+        self._path = db
+        self._local = threading.local()
+
+    def _new_connection(self):
+        """Open a new connection to the database, with all settings applied."""
+        if self._read_only:
+            uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(self._path)))
+            if self._immutable:
+                uri += '&immutable=1'
+            conn = sqlite3.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+        else:
+            conn = sqlite3.connect(self._path, cached_statements=STATEMENT_CACHE_SIZE)
+        if self._mmap_size is not None:
+            conn.execute('PRAGMA mmap_size=%d'%int(self._mmap_size))
+        if self._cache_size is not None:
+            conn.execute('PRAGMA cache_size=%d'%int(self._cache_size))
         if os.path.exists(util.SQLITE3_EXTENSIONS_FILENAME):
-            self.conn.enable_load_extension(True)
-            self.conn.load_extension(util.SQLITE3_EXTENSIONS_FILENAME)
+            conn.enable_load_extension(True)
+            conn.load_extension(util.SQLITE3_EXTENSIONS_FILENAME)
         else:
-            self.conn.create_aggregate("stdev", 1, sqlite3_stdev)
+            # Not used by the query helpers any more, which compute
+            # aggregates in numpy, but kept for user SQL, see .execute().
+            conn.create_aggregate("stdev", 1, sqlite3_stdev)
             #print("SQLite3 extension module not available, some functions will not work.", file=sys.stderr)
             #print("Future niimpy versions will improve this.", file=sys.stderr)
             #print("({0})".format(util.SQLITE3_EXTENSIONS_FILENAME), file=sys.stderr)
-        self._singleuser = self._is_single_user()
-        self._tz = tz
+        return conn
+
+    @property
+    def conn(self):
+        """The sqlite3 connection of the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._new_connection()
+        return conn
 
     def _is_single_user(self):
         """Detect if this is a single-user database
@@ -141,28 +393,34 @@ class Data1(object):
         and thus requires a little bit of special-casing.  Not much, but
         some.
         """
-        tables = self.tables()
-        for table in tables:
-            if table == 'errors': continue
-            # Using pragma_table_info would be better, but this
-            # requires about sqlite 3.16 or above, which is a bit much
-            # (requires ubuntu 18.04 or anaconda).
-            try:
-                self.conn.execute("SELECT user FROM \"%s\" LIMIT 1"%table).fetchall()
-            except sqlite3.OperationalError as e:
-                if 'no such column' in e.args[0]:
-                    self._singleuser = True
-                    #print("Detected single-user database", file=sys.stderr)
-                    return True
-                else:
-                    raise
+        for table in self.tables():
+            if 'user' not in self._table_columns(table):
+                return True
         return False
 
+    def _metadata(self):
+        """Return the metadata cache dict of the database file in use.
+
+        Metadata which is expensive to find out is stored here, so that
+        opening the same unchanged file again is fast.
+        """
+        key = _file_state(self._path)
+        path = key[0]
+        metadata = _metadata_cache.get(key)
+        if metadata is None:
+            # Drop entries of older versions of this file
+            for old_key in [k for k in _metadata_cache if k[0] == path]:
+                _metadata_cache.pop(old_key, None)
+            metadata = _metadata_cache[key] = { }
+        return metadata
+
     def execute(self, *args, **kwargs):
         """Execute rauw SQL code.
 
         Execute raw SQL.  Smply proxy all arguments to
         self.conn.execute().  This is simply a convenience shortcut.
+        A stdev() aggregate function is available in the SQL, from the
+        sqlite extension module or else sqlite3_stdev.
         """
         return self.conn.execute(*args, **kwargs)
 
@@ -170,7 +428,112 @@ class Data1(object):
         """List all tables that are inside of this database.
 
         Returns a set."""
-        return {x[0] for x in self.conn.execute('SELECT name FROM sqlite_master WHERE type="table"') if x[0]!='errors'}
+        metadata = self._metadata()
+        if 'tables' not in metadata:
+            metadata['tables'] = {x[0] for x in self.conn.execute('SELECT name FROM sqlite_master WHERE type="table"') if x[0]!='errors'}
+        return set(metadata['tables'])
+
+    def _table_columns(self, table):
+        """Return the list of column names of a table."""
+        columns = self._metadata().setdefault('columns', { })
+        if table not in columns:
+            columns[table] = [row[1] for row in self.conn.execute('PRAGMA table_info("%s")'%table)]
+        return list(columns[table])
+
+    def _index_columns(self, table):
+        """Return a list with the tuple of indexed columns of each index on a table."""
+        indexes = [ ]
+        for row in self.conn.execute('PRAGMA index_list("%s")'%table):
+            indexes.append(tuple(col[2] for col in self.conn.execute('PRAGMA index_info("%s")'%row[1])))
+        return indexes
+
+    def missing_indexes(self):
+        """Find tables that do not have an index usable by the query helpers.
+
+        All helper functions filter by user and then by a time range, so
+        each table with a time column should have an index starting with
+        (user, time), or (time) for single-user tables.
+
+        Returns a dict of table name -> tuple of columns to index.
+        """
+        missing = { }
+        for table in sorted(self.tables()):
+            columns = self._table_columns(table)
+            if 'time' not in columns:
+                continue
+            wanted = ('user', 'time') if 'user' in columns else ('time', )
+            if not any(index[:len(wanted)] == wanted for index in self._index_columns(table)):
+                missing[table] = wanted
+        return missing
+
+    def optimize(self, sidecar=None):
+        """Create missing (user, time) indexes and update the statistics.
+
+        Builds every index listed by .missing_indexes() and runs ANALYZE
+        so that the query planner can use them.  Per-user reads then
+        become index range scans instead of full table scans.
+
+        If the database file is read-only, the indexes can not be added
+        to it.  If `sidecar` is given (a filename, or True for the
+        default of `<db>.indexed.sqlite3`), the database is copied there
+        and this object switches to using the copy.  An existing sidecar
+        which is newer than the database is reused.  Without `sidecar`,
+        a read-only database is left as it is, with a warning.
+
+        Returns a dict of table name -> name of created index.
+        """
+        missing = self.missing_indexes()
+        if not missing:
+            return { }
+        target = self._db
+        if self._read_only or not _is_writable(self._db):
+            if not sidecar:
+                warnings.warn("Database is read-only, not creating indexes: {}".format(self._db))
+                return { }
+            if sidecar is True:
+                sidecar = self._db + '.indexed.sqlite3'
+            if not (os.path.exists(sidecar)
+                    and os.path.getmtime(sidecar) >= os.path.getmtime(self._db)):
+                dest = sqlite3.connect(sidecar)
+                self.conn.backup(dest)
+                dest.close()
+            target = sidecar
+        conn = sqlite3.connect(target)
+        created = { }
+        for table, columns in missing.items():
+            name = "{}_{}".format(table, '_'.join(columns))
+            conn.execute('CREATE INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+                name, table, ', '.join(columns)))
+            created[table] = name
+        conn.execute('ANALYZE')
+        conn.commit()
+        conn.close()
+        self._connect(target)
+        return created
+
+    def query_plan(self, table, user=ALL, start=None, end=None):
+        """Return the sqlite query plan of each query helper.
+
+        This runs EXPLAIN QUERY PLAN for the queries that .first(),
+        .occurrence(), .hourly(), .timestamps(), .raw() and .iter_raw()
+        would run with these arguments, and is useful to check that
+        indexes are used (see .optimize()).
+
+        Returns a dict of helper name -> list of plan lines.
+        """
+        queries = {
+            'first': self._query_first(table, user, start=start, end=end),
+            'count': self._query_first(table, user, start=start, end=end, _aggregate="count"),
+            'occurrence': self._query_times(table, user, start=start, end=end),
+            'hourly': self._query_times(table, user, start=start, end=end),
+            'timestamps': self._query_timestamps(table, user, start=start, end=end),
+            'raw': self._query_raw(table, user, start=start, end=end),
+            'iter_raw': self._query_iter_raw(table, user, start=start, end=end),
+            }
+        plans = { }
+        for name, (sql, params) in queries.items():
+            plans[name] = [row[-1] for row in self.conn.execute('EXPLAIN QUERY PLAN '+sql, params)]
+        return plans
 
     def _sql_where_user(self, user):
         """Query generation convenience.
@@ -190,18 +553,14 @@ class Data1(object):
         """Query generation convenience.
 
         Generates a SQL "WHERE start <= time AND time < end" line if
-        needed for this query.
+        needed for this query.  The values are bound as the :start and
+        :end parameters, see _sql_params().
         """
         where = ""
-        def to_timestamp(x):
-            if isinstance(x, (int, float)): return x
-            if isinstance(x, str): return dateutil.parser.parse(x).timestamp() # localtime
-            if isinstance(x, datetime.datetime): return x.timestamp()
-            raise ValueError("Unknown timestamp format: {}".format(x))
         if start:
-            where += " AND %s <= time "%(to_timestamp(start))
+            where += " AND :start <= time "
         if end:
-            where += " AND time < %s "%(to_timestamp(end))
+            where += " AND time < :end "
         return where
 
     def _sql_select_user(self, user):
@@ -221,12 +580,13 @@ class Data1(object):
     def _sql_limit(self, limit, offset=None):
         """Query generation convenience.
 
-        Generates a SQL "LIMIT ... OFFSET" line, if needed."""
+        Generates a SQL "LIMIT ... OFFSET" line, if needed.  The values
+        are bound as the :limit and :offset parameters."""
         if offset is not None:
-            if limit is None:  return "LIMIT -1 OFFSET %s"%(int(offset), )
-            else:  return "LIMIT %s OFFSET %s"%(int(limit), int(offset))
+            if limit is None:  return "LIMIT -1 OFFSET :offset"
+            else:  return "LIMIT :limit OFFSET :offset"
         if limit is None: return ""
-        return 'LIMIT %s'%int(limit)
+        return 'LIMIT :limit'
 
     def _sql_order_by(self, order=False):
         """Query generation convenience.
@@ -260,6 +620,23 @@ class Data1(object):
                     group_by_user=self._sql_group_by_user(),
                    )
 
+    def _sql_params(self, user, limit=None, offset=None, start=None, end=None):
+        """Generate the bound parameters for SQL queries.
+
+        This is the counterpart of _sql(): the placeholders it generates
+        are filled from the dict returned here.
+        """
+        params = {'user': user}
+        if start:
+            params['start'] = _to_timestamp(start)
+        if end:
+            params['end'] = _to_timestamp(end)
+        if limit is not None:
+            params['limit'] = int(limit)
+        if offset is not None:
+            params['offset'] = int(offset)
+        return params
+
 
 
     def users(self, table=None):
@@ -267,11 +644,12 @@ class Data1(object):
         if self._singleuser:
             return None
         if table is not None:  tables = [table]
-        else:                  tables = self.tables()
-        users = set()
-        for table_ in tables:
-            users |= {x[0] for x in self.conn.execute('SELECT DISTINCT user FROM "%s"'%table_)}
-        return users
+        else:                  tables = sorted(self.tables())
+        users = self._metadata().setdefault('users', { })
+        if tuple(tables) not in users:
+            users[tuple(tables)] = {x[0] for x in self.conn.execute(
+                " UNION ".join('SELECT user FROM "%s"'%table_ for table_ in tables))}
+        return set(users[tuple(tables)])
 
     def validate_username(self, user):
         """Validate a username, for single/multiuser database and so on.
@@ -298,41 +676,69 @@ class Data1(object):
         """Return table of number of data points per user, per table.
 
         Return a dataframe of row=table, column=user, value=number of
-        counts of that user in that table.
+        counts of that user in that table.  All tables are counted in one
+        query.
         """
-        if self._singleuser:
-            #print(self.tables())
-            user_stats = pd.DataFrame(index=sorted(self.tables()), columns=("count",))
-            #print(user_stats)
-            cur = self.conn.cursor()
-            for table_ in self.tables():
-                for count, in cur.execute('SELECT count(*) FROM "{table}"'.format(table=table_, **self._sql(user=ALL))):
-                    user_stats[table_, 'count'] = count
-            return user_stats
-        user_stats = pd.DataFrame(index=sorted(self.tables()), columns=sorted(self.users()))
-        cur = self.conn.cursor()
-        for table_ in self.tables():
-            for user, count in cur.execute('SELECT {select_user} count(*) FROM "{table}" GROUP BY user'.format(table=table_, **self._sql(user=ALL))):
-                if user is None: continue
-                user_stats[user][table_] = count
-        return user_stats
+        metadata = self._metadata()
+        if 'user_table_counts' not in metadata:
+            tables = sorted(self.tables())
+            queries = [ ]
+            for table_ in tables:
+                user = 'user' if not self._singleuser else 'NULL'
+                queries.append("""SELECT '{name}' AS tbl, {user} AS user, count(*) AS count
+                                  FROM "{table}" {group_by_user}""".format(
+                                      name=table_.replace("'", "''"), table=table_, user=user,
+                                      group_by_user=self._sql_group_by_user()))
+            counts = self.conn.execute(" UNION ALL ".join(queries)).fetchall() if queries else [ ]
+            if self._singleuser:
+                user_stats = pd.DataFrame(index=tables, columns=("count",))
+                for table_, _, count in counts:
+                    user_stats.loc[table_, 'count'] = count
+            else:
+                user_stats = pd.DataFrame(index=tables, columns=sorted({u for _, u, _ in counts if u is not None}))
+                for table_, user, count in counts:
+                    if user is None: continue
+                    user_stats.loc[table_, user] = count
+            metadata['user_table_counts'] = user_stats
+        return metadata['user_table_counts'].copy()
+
+    def _query_first(self, table, user, start=None, end=None, offset=None, _aggregate="min", _limit=None):
+        """Build the SQL and parameters for .first()/.last()/.count()
+
+        Without a limit, the aggregate is applied directly on the table,
+        so that sqlite can answer min/max by seeking in a (user, time)
+        index and count by scanning only the index.
+        """
+        if _limit is None:
+            sql = """SELECT {select_user} {aggregate}(time) AS {result_column_name}
+                       FROM "{table}"
+                       WHERE 1 {where_user} {where_daterange}
+                       {group_by_user}
+                  """.format(table=table,
+                             aggregate=_aggregate,
+                             result_column_name='time' if _aggregate!='count' else 'count',
+                             **self._sql(user=user, start=start, end=end))
+            return sql, self._sql_params(user=user, start=start, end=end)
+        sql = """SELECT {select_user} {aggregate}(time) AS {result_column_name}
+                   FROM (
+                       SELECT * FROM "{table}"
+                       WHERE 1 {where_user} {where_daterange}
+                       {order_by} {limit}
+                   )
+                   {group_by_user}
+              """.format(table=table,
+                         aggregate=_aggregate,
+                         result_column_name='time' if _aggregate!='count' else 'count',
+                         **self._sql(user=user, limit=_limit, offset=offset, start=start, end=end))
+        return sql, self._sql_params(user=user, limit=_limit, start=start, end=end)
 
     def first(self, table, user, start=None, end=None, offset=None, _aggregate="min", _limit=None):
         """Return earliest data point.
 
         Return None if there is no data."""
-        df = pd.read_sql("""SELECT {select_user} {aggregate}(time) AS {result_column_name}
-                              FROM (
-                                  SELECT * FROM "{table}"
-                                  WHERE 1 {where_user} {where_daterange}
-                                  {order_by} {limit}
-                              )
-                              {group_by_user}
-                        """.format(table=table,
-                                   aggregate=_aggregate,
-                                   result_column_name='time' if _aggregate!='count' else 'count',
-                                   **self._sql(user=user, limit=_limit, offset=offset, start=start, end=end)),
-                        self.conn, params={'user':user, })
+        sql, params = self._query_first(table, user, start=start, end=end, offset=offset,
+                                        _aggregate=_aggregate, _limit=_limit)
+        df = pd.read_sql(sql, self.conn, params=params)
         if df.empty:
             return None
         if 'time' in df:
@@ -348,78 +754,156 @@ class Data1(object):
 
         See the "first" for more information."""
         return self.first(*args, _aggregate="count", **kwargs)
-    def exists(self, *args, **kwargs):
+    def exists(self, table, user, start=None, end=None, **kwargs):
         """Returns True if any data exists
 
         Follows the same syntax as .first(), .last(), and .count(), but
-        the limit argument is not used.
+        the limit argument is not used.  This stops at the first
+        matching row.
         """
-        kwargs.pop('limit', None)
-        return self.count(*args, _limit=1, **kwargs) >= 1
-
-
+        sql = """SELECT EXISTS (
+                     SELECT 1 FROM "{table}"
+                     WHERE 1 {where_user} {where_daterange}
+                 )
+              """.format(table=table, **self._sql(user=user, start=start, end=end))
+        params = self._sql_params(user=user, start=start, end=end)
+        return bool(self.conn.execute(sql, params).fetchone()[0])
+
+
+    def _query_times(self, table, user, columns=[], limit=None, offset=None, start=None, end=None):
+        """Build the SQL and parameters for reading times for .occurrence()/.hourly()
+
+        With a limit or offset, the rows are ordered by time so that the
+        earliest data points are read."""
+        paged = limit is not None or offset is not None
+        sql = """SELECT
+                     {select_user} time {columns}
+                 FROM "{table}"
+                 WHERE time IS NOT NULL {where_user} {where_daterange}
+                 {order_by}
+                 {limit_offset}
+              """.format(table=table, columns="".join(", "+c for c in columns),
+                         limit_offset=self._sql_limit(limit, offset),
+                         **self._sql(user=user, order=paged, start=start, end=end))
+        return sql, self._sql_params(user=user, limit=limit, offset=offset, start=start, end=end)
+
+    def _bucket_tz(self):
+        """Timezone used to divide data into days and hours."""
+        if self._tz is None:
+            warnings.warn(DeprecationWarning("From now on, you should explicitely specify timezone with e.g. tz='Europe/Helsinki'.  Specify as part of the reading function."))
+            return util.TZ
+        return self._tz
+
+    def _hour_groups(self, table, user, columns=[], limit=None, offset=None, start=None, end=None):
+        """Read data and group it by user and hour.
+
+        Returns the rows sorted by (user, hour, time), the unixtime of
+        the start of the hour and the local wall-clock time of each row,
+        and a boolean array marking the first row of each group.
+        """
+        sql, params = self._query_times(table, user, columns=columns, limit=limit, offset=offset,
+                                        start=start, end=end)
+        rows = pd.read_sql(sql, self.conn, params=params)
+        hour_start, local = _local_hours(rows['time'].to_numpy(dtype=float), self._bucket_tz())
+        keys = [rows['time'].to_numpy(dtype=float), hour_start]
+        if 'user' in rows:
+            keys.append(pd.factorize(rows['user'], sort=True)[0])
+        order = np.lexsort(keys)
+        rows = rows.iloc[order].reset_index(drop=True)
+        hour_start, local = hour_start[order], local[order]
+        new_group = np.ones(len(rows), dtype=bool)
+        new_group[1:] = hour_start[1:] != hour_start[:-1]
+        if 'user' in rows:
+            users = rows['user'].to_numpy()
+            new_group[1:] |= users[1:] != users[:-1]
+        return rows, hour_start, local, new_group
+
+    def _hour_frame(self, rows, hour_start, local, starts):
+        """DataFrame with the user, day and hour columns of each group."""
+        data = { }
+        if 'user' in rows:
+            data['user'] = rows['user'].to_numpy()[starts]
+        local_hour = local[starts] // 3600 * 3600
+        data['day'] = pd.to_datetime(local_hour, unit='s').strftime('%Y-%m-%d').to_numpy()
+        data['hour'] = local_hour // 3600 % 24
+        index = pd.to_datetime(hour_start[starts], unit='s', utc=True).tz_convert(self._bucket_tz())
+        return pd.DataFrame(data, index=index)
+
+    @_cached_query
     def occurrence(self, table, user, bin_width=720, limit=None, offset=None, start=None, end=None):
+        """Count the data points and the bins with data in each hour.
+
+        Each hour is divided into bins of `bin_width` seconds.  Returns a
+        DataFrame indexed by the start of each hour (with user, day and
+        hour columns), with the number of bins with data ('occurrence'),
+        the number of data points ('count') and the bins with data
+        ('withdata').  Hours are those of the timezone of the database
+        object, independently of the timezone of the computer.  `limit`
+        and `offset` select the data points read, in order of time.
+        """
         n_intervals = 3600 / bin_width
         interval_width = 60/n_intervals
-        df = pd.read_sql("""SELECT {select_user} day, hour,
-                                count(*) as occurrence, sum(bin_count) as count, group_concat(interval) AS withdata
-                            FROM (
-                                SELECT
-                                  strftime('%Y-%m-%d', time, 'unixepoch', 'localtime') AS day,
-                                  CAST(strftime('%H', time, 'unixepoch', 'localtime') AS INTEGER) AS hour,
-                                  CAST(strftime('%M', time, 'unixepoch', 'localtime')/:interval_width AS INTEGER) AS interval,
-                                  count(*) as bin_count
-                                 FROM "{table}"
-                                 WHERE 1 {where_user} {where_daterange}
-                                 GROUP BY day, hour, interval
-                                 {limit}
-                                )
-                            GROUP BY day, hour
-                        """.format(table=table,
-                                   **self._sql(user=user, limit=limit, offset=offset, start=start, end=end)),
-                        self.conn, params={'user':user, 'interval_width':interval_width})
-        util.df_normalize(df, old_tz=util.SYSTEM_TZ, tz=self._tz)
+        rows, hour_start, local, new_group = self._hour_groups(table, user, limit=limit, offset=offset,
+                                                               start=start, end=end)
+        interval = (local % 3600 // 60 / interval_width).astype(np.int64)
+        # Rows are sorted by time within each group, so each new
+        # interval value is a new bin with data.
+        new_bin = new_group.copy()
+        new_bin[1:] |= interval[1:] != interval[:-1]
+        group = np.cumsum(new_group) - 1
+        starts = np.flatnonzero(new_group)
+        df = self._hour_frame(rows, hour_start, local, starts)
+        df['occurrence'] = np.bincount(group[new_bin], minlength=len(starts))
+        df['count'] = np.bincount(group, minlength=len(starts))
+        bins = np.split(interval[new_bin], np.cumsum(df['occurrence'].to_numpy())[:-1])
+        df['withdata'] = [",".join(map(str, b)) for b in bins] if len(starts) else [ ]
         return df
 
-
+    @_cached_query
     def hourly(self, table, user, columns=[], limit=None, offset=None, start=None, end=None):
+        """Count data points and aggregate columns for each hour.
+
+        Returns a DataFrame indexed by the start of each hour (with user,
+        day and hour columns), with the number of data points ('count')
+        and the mean, standard deviation and number of values of each of
+        `columns`.  Hours are those of the timezone of the database
+        object.  `limit` and `offset` select the data points read, in
+        order of time.
+        """
         if isinstance(columns, str):
             columns = [columns]
-        if columns:
-            column_selector = ",\n".join("    avg({0}) AS {0}_mean, stdev({0}) AS {0}_std, count({0}) AS {0}_count".format(c) for c in columns)
-            column_selector = ',\n'+column_selector
-        else:
-            column_selector = ""
-
-        df = pd.read_sql("""SELECT
-                                {select_user}
-                                strftime('%Y-%m-%d', time, 'unixepoch', 'localtime') AS day,
-                                CAST(strftime('%H', time, 'unixepoch', 'localtime') AS INTEGER) AS hour,
-                                count(*) as count {column_selector}
-                            FROM (
-                                SELECT * FROM "{table}" {order_by} {limit}
-                                )
-                            WHERE 1 {where_user} {where_daterange}
-                            GROUP BY day, hour
-                            {limit}
-                         """.format(table=table, column_selector=column_selector,
-                                   **self._sql(user=user, limit=limit, offset=offset, start=start, end=end)),
-                         self.conn, params={'user':user})
-        util.df_normalize(df, old_tz=util.SYSTEM_TZ, tz=self._tz)
+        rows, hour_start, local, new_group = self._hour_groups(table, user, columns=columns,
+                                                               limit=limit, offset=offset,
+                                                               start=start, end=end)
+        starts = np.flatnonzero(new_group)
+        df = self._hour_frame(rows, hour_start, local, starts)
+        df['count'] = np.diff(np.append(starts, len(rows)))
+        for c in columns:
+            values = pd.to_numeric(rows[c], errors='coerce').to_numpy(dtype=float)
+            mean, std, _ = _grouped_mean_std(values, starts)
+            notnull = rows[c].notna().to_numpy(dtype=np.int64)
+            df[c+'_mean'] = mean
+            df[c+'_std'] = std
+            df[c+'_count'] = np.add.reduceat(notnull, starts) if len(starts) else starts
         return df
 
 
+    def _query_timestamps(self, table, user, limit=None, offset=None, start=None, end=None):
+        """Build the SQL and parameters for .timestamps()"""
+        sql = """SELECT
+                     {select_user} time
+                 FROM "{table}"
+                 WHERE 1 {where_user} {where_daterange}
+                 {order_by}
+                 {limit}
+              """.format(table=table,
+                         **self._sql(user=user, limit=limit, offset=offset, start=start, end=end))
+        return sql, self._sql_params(user=user, limit=limit, start=start, end=end)
+
     def timestamps(self, table, user, limit=None, offset=None, start=None, end=None):
-        df = pd.read_sql("""SELECT
-                                {select_user} time
-                            FROM "{table}"
-                            WHERE 1 {where_user} {where_daterange}
-                            {order_by}
-                            {limit}
-                        """.format(table=table,
-                                   **self._sql(user=user, limit=limit, offset=offset, start=start, end=end)
-                                   ),
-                        self.conn, params={'user':user})
+        sql, params = self._query_timestamps(table, user, limit=limit, offset=offset,
+                                             start=start, end=end)
+        df = pd.read_sql(sql, self.conn, params=params)
         if 'user' not in df:
             # Single user data:
             return util.to_datetime(df['time'])
@@ -427,28 +911,163 @@ class Data1(object):
             util.df_normalize(df, tz=self._tz)
             return df
 
-    def raw(self, table, user, limit=None, offset=None, start=None, end=None):
+    def _sql_columns(self, table, columns=None):
+        """Query generation convenience.
+
+        Generates the list of columns to select: all columns if
+        `columns` is None, otherwise the given columns plus the time
+        column (which is needed for the index)."""
+        if columns is None:
+            return "*"
+        if isinstance(columns, str):
+            columns = [columns]
+        columns = list(columns)
+        if 'time' not in columns and 'time' in self._table_columns(table):
+            columns.insert(0, 'time')
+        return ", ".join('"%s"'%c for c in columns)
+
+    def _read_dtypes(self, table, columns=None, dtypes=None):
+        """Select the entries of a dtype mapping that apply to a query."""
+        if not dtypes:
+            return None
+        if isinstance(columns, str):
+            columns = [columns]
+        present = self._table_columns(table)
+        if columns is not None:
+            present = [c for c in present if c in columns or c == 'time']
+        return {c: dtype for c, dtype in dtypes.items() if c in present}
+
+    def _query_raw(self, table, user, limit=None, offset=None, start=None, end=None, columns=None):
+        """Build the SQL and parameters for .raw()"""
+        sql = """SELECT
+                     {columns}
+                 FROM "{table}"
+                 WHERE 1 {where_user} {where_daterange}
+                 {order_by}
+                 {limit}
+              """.format(table=table, columns=self._sql_columns(table, columns),
+                         **self._sql(user=user, limit=limit, offset=offset, start=start, end=end))
+        return sql, self._sql_params(user=user, limit=limit, start=start, end=end)
+
+    @_cached_query
+    def raw(self, table, user, limit=None, offset=None, start=None, end=None, columns=None, dtypes=None):
         """Read all data in a table and return it as a DataFrame.
 
         This reads all data (subject to several possible filters) and
         returns it as a DataFrame.
+
+        If `columns` is given, only read these columns (and time).
+        `dtypes` is a dict of column -> dtype used to convert the data
+        to compact types, for example
+        niimpy.reading.util.AWARE_DTYPES.  Columns not in the data are
+        ignored.
         """
-        df = pd.read_sql("""SELECT
-                                *
-                            FROM "{table}"
-                            WHERE 1 {where_user} {where_daterange}
-                            {order_by}
-                            {limit}
-                        """.format(table=table,
-                                   **self._sql(user=user, limit=limit, offset=offset, start=start, end=end)
-                                   #select_user=self._sql_select_user(user),  where_user=self._sql_where_user(user),
-                                   #limit=self._sql_limit(limit)
-                                   ),
-                        self.conn, params={'user':user})
+        sql, params = self._query_raw(table, user, limit=limit, offset=offset, start=start, end=end,
+                                      columns=columns)
+        df = pd.read_sql(sql, self.conn, params=params, dtype=self._read_dtypes(table, columns, dtypes))
         if 'time' in df:
             util.df_normalize(df, tz=self._tz)
         return df
 
+
+    def _query_iter_raw(self, table, user, start=None, end=None, columns=None):
+        """Build the SQL and parameters for .iter_raw()"""
+        sql = """SELECT
+                     {columns}
+                 FROM "{table}"
+                 WHERE time IS NOT NULL {where_user} {where_daterange}
+                 ORDER BY time, rowid
+              """.format(table=table, columns=self._sql_columns(table, columns),
+                         **self._sql(user=user, start=start, end=end))
+        return sql, self._sql_params(user=user, start=start, end=end)
+
+    def iter_raw(self, table, user, chunksize=10000, start=None, end=None, columns=None, dtypes=None):
+        """Iterate over the data in a table in time-ordered chunks.
+
+        This is the streaming version of .raw(): instead of reading the
+        whole table into memory, yield DataFrames of at most `chunksize`
+        rows each, ordered by time and already normalized.  A single
+        ordered query is run on the connection of the current thread
+        and its rows are fetched `chunksize` at a time, so the table is
+        searched (and, without a (user, time) index, sorted) only once.
+        Rows with a NULL time are not returned.  `columns` and `dtypes`
+        are as in .raw().
+        """
+        if chunksize is None or int(chunksize) < 1:
+            raise ValueError("chunksize must be a positive integer")
+        chunksize = int(chunksize)
+        sql, params = self._query_iter_raw(table, user, start=start, end=end, columns=columns)
+        dtypes = self._read_dtypes(table, columns, dtypes)
+        cursor = self.conn.execute(sql, params)
+        try:
+            names = [d[0] for d in cursor.description]
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    return
+                df = pd.DataFrame.from_records(rows, columns=names, coerce_float=True)
+                del rows
+                if dtypes:
+                    df = df.astype(dtypes)
+                util.df_normalize(df, tz=self._tz)
+                yield df
+                if len(df) < chunksize:
+                    return
+        finally:
+            cursor.close()
+
+    def raw_many(self, table, users, max_workers=None, concat=True, **kwargs):
+        """Read the data of many users in parallel.
+
+        Runs .raw(table, user, **kwargs) for each user in a thread pool
+        of `max_workers` threads.  Each thread uses its own connection,
+        and sqlite does the I/O without holding the GIL.
+
+        Returns one DataFrame with the data of all users (in the order
+        of `users`), or with concat=False a dict of user -> DataFrame.
+        """
+        users = list(users)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            dfs = list(pool.map(lambda user: self.raw(table, user, **kwargs), users))
+        if not concat:
+            return dict(zip(users, dfs))
+        if not dfs:
+            return pd.DataFrame()
+        return pd.concat(dfs)
+
+    def window(self, start, end, tables=None, user=ALL, columns=None, dtypes=None):
+        """Read the same time window from many tables.
+
+        Returns a dict of table name -> DataFrame (as from .raw()) with
+        the data in [start, end) of each table, by default of all
+        tables.  All tables are read within one transaction, so they
+        are a consistent snapshot of the database even if it is being
+        written to, and the start and end times are parsed only once.
+
+        `columns` can be a dict of table name -> list of columns to read
+        from that table.  `dtypes` is as in .raw().  The query result
+        cache is not used, as cached results may be from another
+        version of the database than the snapshot.
+        """
+        start = _to_timestamp(start)
+        end = _to_timestamp(end)
+        if tables is None:
+            tables = sorted(self.tables())
+        columns = columns or { }
+        conn = self.conn
+        own_transaction = not conn.in_transaction
+        if own_transaction:
+            conn.execute('BEGIN')
+        # .raw() without the query result cache
+        raw = Data1.raw.__wrapped__
+        try:
+            return {table: raw(self, table, user, start=start, end=end,
+                               columns=columns.get(table), dtypes=dtypes)
+                    for table in tables}
+        finally:
+            if own_transaction:
+                conn.commit()
+
     def get_survey_score(self, table, user, survey, limit=None, start=None, end=None):
         """Get the survey results, summing scores.
 
@@ -1,16 +1,26 @@
+import codecs
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import itertools
 import pandas as pd
 from zipfile import ZipFile
 import json
+import multiprocessing.util
 import os
+import queue
 import numpy as np
 import email
+import email.parser
 import uuid
 import warnings
 import re
+import threading
 
 from tqdm import tqdm
 from bs4 import BeautifulSoup
 from niimpy.reading import util
+from niimpy.preprocessing import util as preprocessing_util
 import google_takeout_email as email_utils
 from niimpy.reading.html_iterator import ContentDivIterator
 
@@ -21,6 +31,80 @@ except ImportError:
         raise ImportError("Sentiment analysis requested, but the optional dependency 'sentiment' is not installed. To install it, run `pip install niimpy[sentiment]`")
 
 
+class TakeoutArchive():
+    """ A Google Takeout zip file.
+
+    The zip file is opened once and the member names are indexed by
+    folder, so that the files in a folder can be listed without scanning
+    all names. The readers in this module accept either a zip filename
+    or a TakeoutArchive, and are also available as methods that share
+    the open zip file::
+
+        with TakeoutArchive("takeout.zip") as archive:
+            locations = archive.location_history()
+            heart_rate = archive.fit_heart_rate_data()
+
+    Parameters
+    ----------
+
+    zip_filename : str
+        The filename of the zip file.
+    """
+    def __init__(self, zip_filename):
+        self.filename = zip_filename
+        self.zip_file = ZipFile(zip_filename)
+        self.names = self.zip_file.namelist()
+        self._name_set = set(self.names)
+        # Information read from the members, such as the Google Fit data
+        # sources, so that it is only read once
+        self.cache = {}
+        self._open_lock = threading.Lock()
+        # folder -> names of all members in the folder and its subfolders,
+        # in the order of the archive. The root folder is "".
+        self._folders = {}
+        for name in self.names:
+            parts = name.split("/")
+            for i in range(len(parts)):
+                self._folders.setdefault("/".join(parts[:i]), []).append(name)
+
+    def members(self, folder=""):
+        """ Names of the members in a folder (such as "Takeout/Fit/All Data")
+        and its subfolders. """
+        return self._folders.get(folder.rstrip("/"), [])
+
+    def __contains__(self, name):
+        return name in self._name_set
+
+    def open(self, name):
+        # Open members can be read in parallel threads, but opening
+        # them updates the state of the zip file
+        with self._open_lock:
+            return self.zip_file.open(name)
+
+    def read(self, name):
+        return self.zip_file.read(name)
+
+    def close(self):
+        self.zip_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextlib.contextmanager
+def _open_archive(zip_filename):
+    """ Use an open TakeoutArchive as is, or open a zip file for the
+    duration of the with block. """
+    if isinstance(zip_filename, TakeoutArchive):
+        yield zip_filename
+    else:
+        with TakeoutArchive(zip_filename) as archive:
+            yield archive
+
+
 def format_inferred_activity(data, inferred_activity, activity_threshold):
     # Format the activity type column into activity type and
     # activity inference confidence. The data is nested a few
@@ -63,12 +147,148 @@ def format_inferred_activity(data, inferred_activity, activity_threshold):
 
 
 
+# Whitespace and separators between the items of a JSON list
+_JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_json_list(json_file, key, chunk_size=1 << 20):
+    """ Iterate over the items of a list in a JSON file without reading
+    the whole file into memory.
+
+    The file is read in chunks of chunk_size bytes.  The list is found
+    after the first occurrence of the given key, and each item is
+    decoded once, directly from the buffer.  Only the current chunk and
+    the item being decoded are kept in memory.
+
+    Parameters
+    ----------
+    json_file : file
+        A binary file object, e.g. from zipfile.ZipFile.open.
+    key : str
+        The key of the list, e.g. "locations".
+    chunk_size : int, optional
+        Number of bytes to read at a time.
+
+    Yields
+    ------
+    item : object
+        The decoded list items.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    key = '"%s"' % key
+    buffer = ''
+    eof = False
+
+    def read():
+        nonlocal eof
+        chunk = json_file.read(chunk_size)
+        eof = not chunk
+        return text_decoder.decode(chunk, final=eof)
+
+    # Find the start of the list
+    pos = None
+    while pos is None:
+        buffer += read()
+        i = buffer.find(key)
+        if i >= 0:
+            j = buffer.find('[', i + len(key))
+            if j >= 0:
+                pos = j + 1
+                continue
+        elif not eof:
+            # Keep enough to find a key that is split between chunks
+            buffer = buffer[-len(key):]
+        if eof:
+            return
+
+    while True:
+        pos = _JSON_SEPARATORS.match(buffer, pos).end()
+        if pos == len(buffer):
+            if eof:
+                return
+            buffer = read()
+            pos = 0
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The item continues in the next chunk
+            if eof:
+                raise
+            buffer = buffer[pos:] + read()
+            pos = 0
+            continue
+        yield item
+        pos = end
+
+
+def _utc_iso_seconds(date):
+    """ Format a datetime as an ISO 8601 UTC string with second precision,
+    as used in the beginning of Takeout timestamps. Naive datetimes are
+    taken to be in UTC. """
+    date = pd.Timestamp(date)
+    if date.tzinfo is None:
+        date = date.tz_localize('UTC')
+    return date.tz_convert('UTC').strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def _compare_timestamp(timestamp, date, date_iso):
+    """ Compare an ISO 8601 timestamp string to a datetime. Returns -1, 0
+    or 1. UTC timestamps are compared as strings, and only converted to
+    Timestamps if they are within the same second as the datetime. """
+    if timestamp.endswith('Z'):
+        prefix = timestamp[:19]
+        if prefix != date_iso:
+            return -1 if prefix < date_iso else 1
+    timestamp = pd.to_datetime(timestamp, format='ISO8601')
+    date = pd.Timestamp(date)
+    if date.tzinfo is None:
+        date = date.tz_localize('UTC')
+    return (timestamp > date) - (timestamp < date)
+
+
+def iter_json_records(zip_file, filename, key="locations", start_date=None, end_date=None):
+    """ Iterate over the records of a Takeout json file, such as the
+    locations in Records.json, keeping only records with a timestamp
+    after start_date and before end_date.
+
+    Parameters
+    ----------
+    zip_file : zipfile.ZipFile
+        The zip file object.
+    filename : str
+        The name of the file in the zip file.
+    key : str, optional
+        The key of the list of records.
+    start_date : datetime.datetime, optional
+        Only records with timestamp after this are included.
+    end_date : datetime.datetime, optional
+        Only records with timestamp before this are included.
+
+    Yields
+    ------
+    record : dict
+    """
+    start_iso = None if start_date is None else _utc_iso_seconds(start_date)
+    end_iso = None if end_date is None else _utc_iso_seconds(end_date)
+    with zip_file.open(filename) as json_file:
+        for record in iter_json_list(json_file, key):
+            timestamp = record["timestamp"]
+            if start_iso is not None and _compare_timestamp(timestamp, start_date, start_iso) <= 0:
+                continue
+            if end_iso is not None and _compare_timestamp(timestamp, end_date, end_iso) >= 0:
+                continue
+            yield record
+
+
 def read_json_after_timestamp(zip_file, filename, start_date):
-    """ Read the json file from the zip file line by line and discard
-    entries with timestamp before start_date. The dictionary contains
-    a "locations" list. Each entry takes multiple lines and needs to
-    be read fully before including or discarding it.
-    
+    """ Read the json file from the zip file and discard entries with
+    timestamp before start_date. The dictionary contains a "locations"
+    list, which is read incrementally.
+
     Parameters
     ----------
     zip_file : zipfile.ZipFile
@@ -77,46 +297,97 @@ def read_json_after_timestamp(zip_file, filename, start_date):
         The name of the file in the zip file.
     start_date : datetime.datetime
         The timestamp to filter by.
-    
+
     Returns
     -------
     data : list
         A list of dictionaries with json data.
     """
+    return list(iter_json_records(zip_file, filename, start_date=start_date))
 
-    with zip_file.open(filename) as json_file:
-        data = []
-        entry = ""
-        depth = 0
-        for line in json_file:
-            if isinstance(line, bytes):
-                line = line.decode()
-
-            if '"locations":' in line:
-                # list started
-                data = []
-                depth = 0
-                entry = ""
-                # anything after the first "[" is part of the list
-                line = '['.join(line.split("[")[1:])
-
-            for char in line:
-                if char == "{":
-                    depth += 1
-                elif char == "}":
-                    depth -= 1
-                    if depth == 0:
-                        entry += char
-                        entry = json.loads(entry)
-                        if pd.to_datetime(entry["timestamp"], format='ISO8601') > start_date:
-                            data.append(entry)
-                        entry = ""
-                        char = ""
-                if depth > 0:
-                    entry += char
-                    
-                        
-    return data
+
+def _top_activity(record):
+    """ The inferred activity with the highest confidence in a location
+    record, or an empty dict. """
+    try:
+        return record["activity"][0]["activity"][0]
+    except (KeyError, IndexError, TypeError):
+        return {}
+
+
+def _inferred_location(record):
+    """ The first inferred location in a location record, or an empty dict. """
+    try:
+        return record["inferredLocation"][0]
+    except (KeyError, IndexError, TypeError):
+        return {}
+
+
+def _float(value):
+    """ Convert a json value to float. Missing values and empty strings
+    are NaN. """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _e7(value):
+    return _float(value) / 10000000
+
+
+# Columns of location_history which can be read directly from the
+# records into arrays: column name -> (dtype, function of the record)
+LOCATION_COLUMNS = {
+    "latitude": (np.float64, lambda r: _e7(r.get("latitudeE7"))),
+    "longitude": (np.float64, lambda r: _e7(r.get("longitudeE7"))),
+    "accuracy": (np.float64, lambda r: _float(r.get("accuracy"))),
+    "altitude": (np.float64, lambda r: _float(r.get("altitude"))),
+    "velocity": (np.float64, lambda r: _float(r.get("velocity"))),
+    "heading": (np.float64, lambda r: _float(r.get("heading"))),
+    "verticalaccuracy": (np.float64, lambda r: _float(r.get("verticalAccuracy"))),
+    "source": (object, lambda r: r.get("source", np.nan)),
+    "device": (object, lambda r: r.get("deviceTag", np.nan)),
+    "placeid": (object, lambda r: r.get("placeId", np.nan)),
+    "activity_type": (object, lambda r: _top_activity(r).get("type", np.nan)),
+    "activity_inference_confidence": (np.float64, lambda r: _float(_top_activity(r).get("confidence"))),
+    "inferred_latitude": (np.float64, lambda r: _e7(_inferred_location(r).get("latitudeE7"))),
+    "inferred_longitude": (np.float64, lambda r: _e7(_inferred_location(r).get("longitudeE7"))),
+}
+
+
+def _grow(array, size):
+    new = np.empty(size, dtype=array.dtype)
+    new[:len(array)] = array
+    return new
+
+
+def _read_location_columns(records, columns, size=1024):
+    """ Read the given LOCATION_COLUMNS from an iterable of location
+    records into arrays, in a single pass. The arrays are allocated in
+    advance and doubled in size when full.
+
+    Returns
+    -------
+    timestamps : numpy.ndarray
+        ISO 8601 timestamp strings
+    arrays : dict
+        column name -> numpy.ndarray
+    """
+    extractors = [(column, LOCATION_COLUMNS[column][1]) for column in columns]
+    timestamps = np.empty(size, dtype=object)
+    arrays = {column: np.empty(size, dtype=LOCATION_COLUMNS[column][0]) for column in columns}
+    n = 0
+    for record in records:
+        if n == size:
+            size *= 2
+            timestamps = _grow(timestamps, size)
+            arrays = {column: _grow(array, size) for column, array in arrays.items()}
+        timestamps[n] = record["timestamp"]
+        for column, extract in extractors:
+            arrays[column][n] = extract(record)
+        n += 1
+    return timestamps[:n], {column: array[:n] for column, array in arrays.items()}
 
 
 def location_history(
@@ -127,7 +398,8 @@ def location_history(
         user = None,
         start_date = None,
         end_date = None,
-        timezone = "Europe/Helsinki"
+        timezone = "Europe/Helsinki",
+        columns = None
     ):
     """  Read the location history from a google takeout zip file.
 
@@ -161,24 +433,37 @@ def location_history(
         Whether all raw data columns should be kept. This includes lists of
         wifi check points and mostly null device and OS data.
 
+    columns: list of str, optional
+        If given, only return these columns (and user). With the default
+        inferred_activity="highest", the columns are read directly from
+        the file into arrays, which is much faster and uses less memory
+        for large files. The available columns are the keys of
+        LOCATION_COLUMNS.
+
     Returns
     -------
 
     data : pandas.DataFrame
     """
     
+    if columns is not None:
+        unknown = set(columns) - set(LOCATION_COLUMNS) - {"user"}
+        if unknown:
+            raise ValueError(f"Unknown location history columns: {sorted(unknown)}")
+        columns = [c for c in columns if c != "user"]
+        if inferred_activity == "highest":
+            return _location_history_columns(zip_filename, columns, user, start_date, end_date, timezone)
+
     column_name_map = {'deviceTag': "device"}
     drop_columns = ['deviceDesignation', 'activeWifiScan.accessPoints', 'locationMetadata', 'osLevel']
 
     # Read json data from the zip file and convert to pandas DataFrame.
+    # The records are streamed from the file and filtered by start date
+    # while reading.
     try:
-        zip_file = ZipFile(zip_filename)
-        filename = "Takeout/Location History (Timeline)/Records.json"
-        if start_date is not None:
-            json_data = read_json_after_timestamp(zip_file, filename, start_date)
-        else:
-            json_data  = zip_file.read(filename)
-            json_data = json.loads(json_data)["locations"]
+        with _open_archive(zip_filename) as archive:
+            filename = "Takeout/Location History (Timeline)/Records.json"
+            json_data = list(iter_json_records(archive.zip_file, filename, start_date=start_date))
     except KeyError:
         return pd.DataFrame()
     data = pd.json_normalize(json_data)
@@ -214,6 +499,29 @@ def location_history(
     util.format_column_names(data)
     util.set_timezone(data, tz=timezone)
 
+    if columns is not None:
+        data = data[[c for c in columns if c in data.columns]].copy()
+
+    if user is None:
+        user = uuid.uuid1()
+    data["user"] = user
+    return data
+
+
+def _location_history_columns(zip_filename, columns, user, start_date, end_date, timezone):
+    """ Fast path of location_history: read only the given columns. """
+    try:
+        with _open_archive(zip_filename) as archive:
+            filename = "Takeout/Location History (Timeline)/Records.json"
+            records = iter_json_records(archive.zip_file, filename, start_date=start_date, end_date=end_date)
+            timestamps, arrays = _read_location_columns(records, columns)
+    except KeyError:
+        return pd.DataFrame()
+
+    index = pd.DatetimeIndex(pd.to_datetime(timestamps, format='ISO8601'), name="timestamp")
+    data = pd.DataFrame(arrays, index=index, columns=columns)
+    util.set_timezone(data, tz=timezone)
+
     if user is None:
         user = uuid.uuid1()
     data["user"] = user
@@ -250,9 +558,9 @@ def activity(
     """
 
     # Read the csv files in the activity directory and concatenate
-    with ZipFile(zip_filename) as zip_file:
+    with _open_archive(zip_filename) as archive:
         filename = None
-        for f in zip_file.namelist():
+        for f in archive.names:
             # Skip the file with daily agregated data for now.
             if f.endswith('Daily activity metrics.csv'):
                 filename = f
@@ -262,7 +570,7 @@ def activity(
             return pd.DataFrame()
         
         # Read the more fine grained data for each date
-        data = pd.read_csv(zip_file.open(filename))
+        data = pd.read_csv(archive.open(filename))
     
     data["timestamp"] = pd.to_datetime(data["Date"])
 
@@ -348,13 +656,495 @@ def infer_user_email(df):
     return address_counts.keys()[0]
 
 
+# Messages in mbox files start at lines beginning with "From "
+MBOX_SEPARATOR = b"\nFrom "
+MBOX_INTERNAL_FILENAME = "Takeout/Mail/All mail Including Spam and Trash.mbox"
+MBOX_INDEX_VERSION = 1
+_MBOX_DATE = re.compile(rb"^date:[ \t]*(.*(?:\r?\n[ \t].*)*)", re.IGNORECASE | re.MULTILINE)
+
+
+@contextlib.contextmanager
+def _open_mbox(filename):
+    """ Open the mailbox of a Google Takeout zip file (or a TakeoutArchive)
+    or an .mbox file in binary mode. """
+    if isinstance(filename, TakeoutArchive):
+        with filename.open(MBOX_INTERNAL_FILENAME) as mbox_file:
+            yield mbox_file
+    elif filename.endswith(".zip"):
+        with ZipFile(filename) as zip_file, zip_file.open(MBOX_INTERNAL_FILENAME) as mbox_file:
+            yield mbox_file
+    elif filename.endswith(".mbox"):
+        with open(filename, "rb") as mbox_file:
+            yield mbox_file
+    else:
+        raise ValueError("Unknown file")
+
+
+def _parse_email_date(value):
+    """ Parse a Date header into a UTC timestamp. An empty value is NaT. """
+    if value:
+        value = email.utils.parsedate_to_datetime(value)
+    timestamp = pd.to_datetime(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize("UTC")
+    return timestamp
+
+
+def _header_date(header):
+    """ The first Date header in the header bytes of a message. """
+    match = _MBOX_DATE.search(header)
+    if match is None:
+        return ""
+    return match.group(1).strip().decode("utf-8", "replace")
+
+
+def _header_end(buffer, start, end):
+    """ Position of the empty line after the headers of the message
+    starting at buffer[start], or -1 if it is not before end. """
+    positions = [p for p in (buffer.find(b"\n\n", start, end),
+                             buffer.find(b"\n\r\n", start, end)) if p >= 0]
+    return min(positions) if positions else -1
+
+
+def _split_mbox(mbox_file, headers_only=False, index=None, chunk_size=1 << 24):
+    """ Read the messages of a mailbox in one pass and yield the raw
+    bytes of each message, or only its headers if headers_only is true.
+
+    The file is read in chunks and the messages are split at the
+    separator lines, so that only one chunk and the current message are
+    kept in memory. If index is given (a dict of "offset", "length" and
+    "date" lists), the start offset, length and Date header of each
+    message are appended to it.
+    """
+    buffer = b""
+    base = 0      # Offset of buffer[0] in the file
+    start = 0     # Position of the current message in the buffer
+    search = 0    # Position in the buffer to look for the next separator from
+    eof = False
+    while not eof:
+        chunk = mbox_file.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[start:] + chunk
+        base += start
+        search -= start
+        start = 0
+        while start < len(buffer):
+            separator = buffer.find(MBOX_SEPARATOR, search)
+            if separator >= 0:
+                end = separator + 1
+            elif eof:
+                end = len(buffer)
+            else:
+                # The separator may be split between chunks
+                search = max(len(buffer) - len(MBOX_SEPARATOR) + 1, start)
+                break
+            message = buffer[start:end]
+            if headers_only or index is not None:
+                # The headers end at the first empty line, or at the
+                # next message if it has no body
+                header_end = _header_end(message, 0, len(message))
+                headers = message if header_end < 0 else message[:header_end + 1]
+            if index is not None:
+                index["offset"].append(base + start)
+                index["length"].append(end - start)
+                index["date"].append(_header_date(headers))
+            yield headers if headers_only else message
+            start = search = end
+
+
+def _scan_mbox(mbox_file, chunk_size=1 << 24):
+    """ Find the start offset, length and the Date header of each
+    message. Only the headers of the messages are kept in memory, not
+    the messages themselves. """
+    index = {"offset": [], "length": [], "date": []}
+    for _ in _split_mbox(mbox_file, headers_only=True, index=index, chunk_size=chunk_size):
+        pass
+    return index["offset"], index["length"], index["date"]
+
+
+def _mbox_source(filename):
+    """ The path, size and mtime of the file a mailbox index belongs to.
+    The index can not be stored for mailboxes that are not files on
+    disk. """
+    if isinstance(filename, TakeoutArchive):
+        filename = filename.filename
+    if not isinstance(filename, (str, os.PathLike)) or not os.path.isfile(filename):
+        raise ValueError("index_file requires a zip or .mbox file on disk, not a file object")
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+
+def _load_mbox_index(index_file, source):
+    """ The stored index of a mailbox, or None if it does not exist or
+    the mailbox has changed. """
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != MBOX_INDEX_VERSION or index.get("source") != source:
+        return None
+    return index
+
+
+def _store_mbox_index(index_file, source, offsets, lengths, dates):
+    """ Parse the dates of a scanned mailbox, and store the index in
+    index_file if it is not None. """
+    timestamps = []
+    for date in dates:
+        try:
+            timestamp = _parse_email_date(date)
+        except Exception:
+            timestamp = pd.NaT
+        timestamps.append(None if pd.isnull(timestamp) else timestamp.value)
+    index = {
+        "version": MBOX_INDEX_VERSION,
+        "source": source,
+        "offset": offsets,
+        "length": lengths,
+        "date": dates,
+        "timestamp": timestamps,
+    }
+    if index_file is not None:
+        with open(index_file, "w") as f:
+            json.dump(index, f)
+    return index
+
+
+def _mbox_index_frame(index):
+    timestamps = pd.to_datetime(pd.array(index["timestamp"], dtype="Int64"), utc=True)
+    return pd.DataFrame({
+        "offset": np.array(index["offset"], dtype=np.int64),
+        "length": np.array(index["length"], dtype=np.int64),
+        "date": index["date"],
+        "timestamp": timestamps,
+    })
+
+
+def mbox_index(filename, index_file=None):
+    """ Index the messages of a GMail mailbox.
+
+    The mailbox is scanned for the byte offset and the Date header of
+    each message, so that email_activity can skip messages outside the
+    requested dates without parsing them. If index_file is given, the
+    index is stored there and reused until the mailbox file changes.
+
+    Parameters
+    ----------
+
+    filename : str or TakeoutArchive
+        A Google Takeout zip file or an .mbox file.
+    index_file : str (optional)
+        A file for storing the index, e.g. in a cache directory.
+        By default the index is not stored. The index can only be
+        stored for files on disk, a ValueError is raised for a
+        TakeoutArchive opened from a file object.
+
+    Returns
+    -------
+
+    index : pandas.DataFrame
+        The offset, length, date header and timestamp (UTC, NaT if the
+        date cannot be parsed) of each message, in mailbox order.
+    """
+    source = _mbox_source(filename) if index_file is not None else None
+    index = _load_mbox_index(index_file, source) if index_file is not None else None
+    if index is None:
+        with _open_mbox(filename) as mbox_file:
+            offsets, lengths, dates = _scan_mbox(mbox_file)
+        index = _store_mbox_index(index_file, source, offsets, lengths, dates)
+    return _mbox_index_frame(index)
+
+
+def _email_date(date):
+    """ A start_date or end_date as a timezone-aware Timestamp. Naive
+    dates are in the default timezone of niimpy. """
+    if date is None:
+        return None
+    date = pd.Timestamp(date)
+    if date.tzinfo is None:
+        date = date.tz_localize(preprocessing_util.TZ)
+    return date
+
+
+def _select_messages(index, start_date, end_date):
+    """ (offset, length) of the messages that may be within the dates.
+    Messages without a valid date are always included, so that they are
+    reported when parsed. """
+    selected = pd.Series(True, index=index.index)
+    if start_date is not None:
+        selected &= ~(index["timestamp"] < start_date)
+    if end_date is not None:
+        selected &= ~(index["timestamp"] > end_date)
+    index = index[selected]
+    return list(zip(index["offset"].tolist(), index["length"].tolist()))
+
+
+def _read_headers(mbox_file, length, chunk_size=8192):
+    """ Read the headers of a message of the given length, up to the
+    empty line after them. Returns the headers and the number of bytes
+    read. """
+    data = b""
+    while len(data) < length:
+        start = max(len(data) - 2, 0)
+        data += mbox_file.read(min(chunk_size, length - len(data)))
+        end = _header_end(data, start, len(data))
+        if end >= 0:
+            return data[:end + 1], len(data)
+    return data, len(data)
+
+
+def _read_messages(mbox_file, spans, headers_only=False):
+    """ Read the messages at the given spans of an indexed mailbox.
+    Skipped messages, and the bodies if headers_only is true, are not
+    read from .mbox files. """
+    position = 0
+    for offset, length in spans:
+        if offset != position:
+            mbox_file.seek(offset)
+        if headers_only:
+            message, read = _read_headers(mbox_file, length)
+        else:
+            message = mbox_file.read(length)
+            read = length
+        position = offset + read
+        yield message
+
+
+def _email_batches(messages, batch_size=1000, batch_bytes=1 << 24):
+    """ Group raw messages into batches for parsing. """
+    batch = []
+    size = 0
+    for message in messages:
+        batch.append(message)
+        size += len(message)
+        if len(batch) >= batch_size or size >= batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def _decode_text_part(part):
+    """ Decode a text part of a message as in email_utils.extract_content. """
+    payload = part.get_payload(decode=True)
+    charset = part.get_content_charset()
+    try:
+        if charset:
+            return payload.decode(charset)
+        return payload.decode()
+    except UnicodeDecodeError:
+        # Failed to decode the string. If chardet fails too, allow the
+        # exception to propagate
+        import chardet
+        charset = chardet.detect(payload)["encoding"]
+        return payload.decode(charset)
+
+
+def _content_counts(message):
+    """ Character and word count of the plain text content of a message.
+
+    This is equal to counting the characters and words in
+    email_utils.extract_content(message), but the parts are counted one
+    at a time instead of joining them into one string.
+    """
+    character_count = 0
+    word_count = 0
+    in_word = False  # The previous part ended in the middle of a word
+    for part in message.walk():
+        if part.get_content_type() != "text/plain":
+            continue
+        text = _decode_text_part(part)
+        if not text:
+            continue
+        character_count += len(text)
+        word_count += len(text.split())
+        if in_word and not text[0].isspace():
+            # The word continues from the previous part
+            word_count -= 1
+        in_word = not text[-1].isspace()
+    return character_count, word_count
+
+
+def _email_row(message, start_date, end_date, content_stats=True, content=False):
+    """ Extract the header data of a message for email_activity. Returns
+    None if the message is not within the dates. If content is true, the
+    text content is included for sentiment analysis (None if it cannot
+    be decoded). """
+    # Several fields have different alternate spellings.
+    # We use message.get to check all we have encountered
+    # so far.
+
+    # We use the date entry as the timestamp
+    try:
+        timestamp = message.get("Date", "")
+        timestamp = message.get("date", timestamp)
+        timestamp = _parse_email_date(timestamp)
+        if start_date is not None and timestamp  and timestamp < start_date:
+            return None
+        if end_date is not None and timestamp > end_date:
+            return None
+    except Exception as e:
+        warnings.warn(f"Could not parse message timestamp: {timestamp}")
+        warnings.warn(f"Error: {e}")
+        return None
+
+    # Extract received time and convert to datetime.
+    # Entries are separated by ";" and the date is the last 
+    # one
+    received = message.get("received", "")
+    received = message.get("received", received)
+    received = received.split(";")[-1].strip()
+    try:
+        if received:
+            received = email.utils.parsedate_to_datetime(received)
+        received = pd.to_datetime(received)
+    except:
+        warnings.warn(f"Failed to format received time: {received}")
+
+    in_reply_to = message.get("In-Reply-To", "")
+    in_reply_to = message.get("In-reply-to", in_reply_to)
+    in_reply_to = message.get("in-reply-to", in_reply_to)
+    in_reply_to = message.get("Reply-To", in_reply_to)
+    in_reply_to = message.get("Reply-to", in_reply_to)
+    in_reply_to = message.get("Mail-Reply-To", in_reply_to)
+    in_reply_to = message.get("Mail-Followup-To", in_reply_to)
+
+    cc = str(message.get("CC", ""))
+    cc = str(message.get("Cc", cc))
+    cc = str(message.get("cc", cc))
+    bcc = str(message.get("Bcc", ""))
+    bcc = str(message.get("BCC", bcc))
+    bcc = str(message.get("BCc", bcc))
+    bcc = str(message.get("bcc", bcc))
+
+    message_id = str(message.get("Message-ID", ""))
+    message_id = str(message.get("Message-Id", message_id))
+    message_id = str(message.get("Message-id", message_id))
+    message_id = str(message.get("message-id", message_id))
+
+    from_address = str(message.get("From", ""))
+    from_address = str(message.get("FROM", from_address))
+    from_address = str(message.get("from", from_address))
+
+    to_address = str(message.get("To", ""))
+    to_address = str(message.get("TO", to_address))
+    to_address = str(message.get("to", to_address))
+    to_address = str(message.get("Sender", to_address))
+    to_address = str(message.get("sender", to_address))
+
+    row = {
+        "timestamp": timestamp,
+        "received": received,
+        "from": email_utils.strip_address(from_address),
+        "to": email_utils.parse_address_list(to_address),
+        "cc": email_utils.parse_address_list(cc),
+        "bcc": email_utils.parse_address_list(bcc),
+        "message_id": message_id,
+        "in_reply_to": in_reply_to,
+    }
+
+    # Try to decode the message. If this fails, report the error
+    # add use NaN as the content.
+    if content:
+        try:
+            row["content"] = email_utils.extract_content(message)
+        except Exception as e:
+            print(f"Failed to decode message: {e}")
+            row["content"] = None
+        if content_stats:
+            text = row["content"]
+            row["character_count"] = np.nan if text is None else len(text)
+            row["word_count"] = np.nan if text is None else len(text.split())
+    elif content_stats:
+        try:
+            row["character_count"], row["word_count"] = _content_counts(message)
+        except Exception as e:
+            print(f"Failed to decode message: {e}")
+            row["character_count"] = np.nan
+            row["word_count"] = np.nan
+    return row
+
+
+def _email_rows(messages, start_date, end_date, content_stats=True, content=False):
+    """ Parse a batch of raw messages (runs in a worker). Warnings are
+    returned so that they can be raised in the main process. Without
+    content_stats or content, only the headers are parsed. """
+    if content_stats or content:
+        parse = email.message_from_bytes
+    else:
+        parse = email.parser.BytesHeaderParser().parsebytes
+    rows = []
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        for message in messages:
+            row = _email_row(parse(message), start_date, end_date, content_stats, content)
+            if row is not None:
+                rows.append(row)
+    return rows, [str(warning.message) for warning in caught]
+
+
+def _parse_email_batches(batches, start_date, end_date, content_stats, content, max_workers):
+    """ Parse batches of messages in a process pool, yielding the results
+    in mailbox order. A mailbox of only one batch is parsed in this
+    process. """
+    batches = iter(batches)
+    first = list(itertools.islice(batches, 2))
+    if max_workers == 1 or len(first) < 2:
+        for batch in itertools.chain(first, batches):
+            yield _email_rows(batch, start_date, end_date, content_stats, content)
+        return
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        # Limit the number of batches in memory
+        pending = collections.deque()
+        for batch in itertools.chain(first, batches):
+            pending.append(pool.submit(_email_rows, batch, start_date, end_date, content_stats, content))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _sentiment_consumer(contents, sentiment_batch_size, sentiments, pbar):
+    """ Run sentiment analysis on (position, content) items from a queue
+    until None, storing the results in sentiments by position. Runs in a
+    thread while email_activity keeps parsing messages. """
+    item = ()
+    try:
+        batch = []
+        while item is not None:
+            item = contents.get()
+            if item is not None:
+                batch.append(item)
+            if batch and (item is None or len(batch) >= sentiment_batch_size):
+                results = get_sentiment([content for _, content in batch])
+                for (position, _), result in zip(batch, results):
+                    sentiments[position] = result
+                pbar.update(len(batch))
+                batch = []
+    except BaseException:
+        # Keep taking items so that the parser is not blocked, unless the
+        # parser has already finished
+        while item is not None:
+            item = contents.get()
+        raise
+
+
 class email_file():
-    """ Opens both Google Takeout zip files and .mbox files. """
+    """ Opens Google Takeout zip files (also as a TakeoutArchive) and
+    .mbox files. """
     def __init__(self, filename):
         self.filename = filename
-        if filename.endswith(".zip"):
+        self.zip_file = None
+        internal_filename = "Takeout/Mail/All mail Including Spam and Trash.mbox"
+        if isinstance(filename, TakeoutArchive):
+            self.mailbox_file = filename.open(internal_filename)
+        elif filename.endswith(".zip"):
             self.zip_file = ZipFile(filename)
-            internal_filename = "Takeout/Mail/All mail Including Spam and Trash.mbox"
             self.mailbox_file = self.zip_file.open(internal_filename)
         elif filename.endswith(".mbox"):
             self.mailbox_file = open(filename)
@@ -370,7 +1160,7 @@ class email_file():
     def close(self):
         self.mailbox.close()
         self.mailbox_file.close()
-        if self.filename.endswith(".zip"):
+        if self.zip_file is not None:
             self.zip_file.close()
 
 
@@ -431,7 +1221,10 @@ def email_activity(
         sentiment_batch_size = 100,
         start_date = None,
         end_date = None,
-        timezone = "Europe/Helsinki"
+        timezone = "Europe/Helsinki",
+        max_workers = None,
+        content_stats = True,
+        index_file = None,
     ):
     """ Extract message header data from the GMail inbox in
     a Google Takeout zip file.
@@ -458,115 +1251,91 @@ def email_activity(
         included.
     end_date : datetime.datetime, optional
         The end date for the data. If provided, only data before this date is
-        included.
+        included. Naive dates are in the default timezone of niimpy.
+    max_workers : int, optional
+        Number of processes used to parse the messages. Large mailboxes
+        are parsed in parallel unless this is 1.
+    content_stats : bool, optional
+        Include the character and word counts of the message content.
+        If False, only the message headers are read and parsed, which is
+        much faster, and the columns are not included. Defaults to True.
+    index_file : str, optional
+        A file for storing the message index (see mbox_index). The index
+        is built while the messages are read, and when it is reused,
+        messages outside start_date and end_date are not read at all.
+        By default the mailbox is read once and no index is stored. Only
+        supported for files on disk, not for file objects.
         
     Returns
     -------
 
     data : pandas.DataFrame
     """
-    try:
-        mailbox = email_file(filename)
-    except KeyError:
-        return pd.DataFrame()
+    start_date = _email_date(start_date)
+    end_date = _email_date(end_date)
+    headers_only = not (content_stats or sentiment)
+    index = None
+    if index_file is not None:
+        source = _mbox_source(filename)
+        index = _load_mbox_index(index_file, source)
+        if index is None:
+            scanned = {"offset": [], "length": [], "date": []}
 
     data = []
-    for message in mailbox.messages:
-        # Several fields have different alternate spellings.
-        # We use message.get to check all we have encountered
-        # so far.
-
-        # We use the date entry as the timestamp
-        try:
-            timestamp = message.get("Date", "")
-            timestamp = message.get("date", timestamp)
-            if timestamp:
-                timestamp = email.utils.parsedate_to_datetime(timestamp)
-            timestamp = pd.to_datetime(timestamp)
-            if timestamp.tzinfo is None:
-                timestamp = timestamp.tz_localize("UTC")
-            if start_date is not None and timestamp  and timestamp < start_date:
-                continue
-            if end_date is not None and timestamp > end_date:
-                continue
-        except Exception as e:
-            warnings.warn(f"Could not parse message timestamp: {timestamp}")
-            warnings.warn(f"Error: {e}")
-            continue
-
-        # Extract received time and convert to datetime.
-        # Entries are separated by ";" and the date is the last 
-        # one
-        received = message.get("received", "")
-        received = message.get("received", received)
-        received = received.split(";")[-1].strip()
-        try:
-            if received:
-                received = email.utils.parsedate_to_datetime(received)
-            received = pd.to_datetime(received)
-        except:
-            warnings.warn(f"Failed to format received time: {received}")
-
-        in_reply_to = message.get("In-Reply-To", "")
-        in_reply_to = message.get("In-reply-to", in_reply_to)
-        in_reply_to = message.get("in-reply-to", in_reply_to)
-        in_reply_to = message.get("Reply-To", in_reply_to)
-        in_reply_to = message.get("Reply-to", in_reply_to)
-        in_reply_to = message.get("Mail-Reply-To", in_reply_to)
-        in_reply_to = message.get("Mail-Followup-To", in_reply_to)
-
-        cc = str(message.get("CC", ""))
-        cc = str(message.get("Cc", cc))
-        cc = str(message.get("cc", cc))
-        bcc = str(message.get("Bcc", ""))
-        bcc = str(message.get("BCC", bcc))
-        bcc = str(message.get("BCc", bcc))
-        bcc = str(message.get("bcc", bcc))
-
-        message_id = str(message.get("Message-ID", ""))
-        message_id = str(message.get("Message-Id", message_id))
-        message_id = str(message.get("Message-id", message_id))
-        message_id = str(message.get("message-id", message_id))
-
-        from_address = str(message.get("From", ""))
-        from_address = str(message.get("FROM", from_address))
-        from_address = str(message.get("from", from_address))
-
-        to_address = str(message.get("To", ""))
-        to_address = str(message.get("TO", to_address))
-        to_address = str(message.get("to", to_address))
-        to_address = str(message.get("Sender", to_address))
-        to_address = str(message.get("sender", to_address))
-
-        # Try to decode the message. If this fails, report the error
-        # add use NaN as the content.
+    with contextlib.ExitStack() as stack:
         try:
-            content = email_utils.extract_content(message)
-            character_count = len(content)
-            word_count = len(content.split())
-        except Exception as e:
-            print(f"Failed to decode message: {e}")
-            character_count = np.nan
-            word_count = np.nan
-
-        row = {
-            "timestamp": timestamp,
-            "received": received,
-            "from": email_utils.strip_address(from_address),
-            "to": email_utils.parse_address_list(to_address),
-            "cc": email_utils.parse_address_list(cc),
-            "bcc": email_utils.parse_address_list(bcc),
-            "message_id": message_id,
-            "in_reply_to": in_reply_to,
-            "character_count": character_count,
-            "word_count": word_count,
-        }
-        data.append(row)
+            mbox_file = stack.enter_context(_open_mbox(filename))
+        except KeyError:
+            return pd.DataFrame()
+        if index is None:
+            # Read the whole mailbox once. The dates are checked when
+            # the messages are parsed, and the index is built on the way
+            # if it is stored.
+            n_messages = None
+            messages = _split_mbox(mbox_file, headers_only, scanned if index_file is not None else None)
+        else:
+            spans = _select_messages(_mbox_index_frame(index), start_date, end_date)
+            n_messages = len(spans)
+            messages = _read_messages(mbox_file, spans, headers_only)
+        parsed = _parse_email_batches(
+            _email_batches(messages), start_date, end_date, content_stats, sentiment, max_workers
+        )
+        if sentiment:
+            # Sentiment analysis runs in a thread while the messages are
+            # parsed. The queue is bounded, so that the contents of the
+            # messages are not all kept in memory.
+            if n_messages is None:
+                print("Running sentiment analysis on the messages.")
+            else:
+                print(f"Running sentiment analysis on up to {n_messages} messages.")
+            sentiments = {}
+            contents = queue.Queue(maxsize=4 * sentiment_batch_size)
+            with ThreadPoolExecutor(max_workers=1) as pool, tqdm(total=n_messages) as pbar:
+                consumer = pool.submit(_sentiment_consumer, contents, sentiment_batch_size, sentiments, pbar)
+                try:
+                    for rows, caught in parsed:
+                        for message in caught:
+                            warnings.warn(message)
+                        for row in rows:
+                            content = row.pop("content")
+                            if content is not None:
+                                contents.put((len(data), content))
+                            data.append(row)
+                finally:
+                    contents.put(None)
+                consumer.result()
+        else:
+            for rows, caught in parsed:
+                for message in caught:
+                    warnings.warn(message)
+                data += rows
 
-    mailbox.close()
+    if index_file is not None and index is None:
+        _store_mbox_index(index_file, source, scanned["offset"], scanned["length"], scanned["date"])
 
     df = pd.DataFrame(data)
     df.dropna(subset=["timestamp"], inplace=True)
+    positions = df.index
     df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
 
     user_email = infer_user_email(df)
@@ -586,10 +1355,11 @@ def email_activity(
     util.format_column_names(df)
     util.set_timezone(df, tz=timezone)
 
-    # Run sentiment analysis if requested. This might take some time.
+    # Join the sentiments by the position of the message
     if sentiment:
-        print(f"Running sentiment analysis on {len(df)} messages.")
-        sentiment_analysis_from_email(df, filename, sentiment_batch_size, start_date, end_date)
+        results = [sentiments.get(position) for position in positions]
+        df["sentiment"] = [np.nan if r is None else r["label"] for r in results]
+        df["sentiment_score"] = [np.nan if r is None else r["score"] for r in results]
 
     return df
 
@@ -668,19 +1438,19 @@ def chat(
     group_index = 0
     user_emails = []
     user_names = []
-    with ZipFile(zip_filename) as zip_file:
+    with _open_archive(zip_filename) as archive:
         # Find the user email from Takeout/Google Chat/Users/*/user_info.json
-        for filename in zip_file.namelist():
-            if filename.startswith("Takeout/Google Chat/Users/") and filename.endswith("user_info.json"):
-                with zip_file.open(filename) as json_file:
+        for filename in archive.members("Takeout/Google Chat/Users"):
+            if filename.endswith("user_info.json"):
+                with archive.open(filename) as json_file:
                     user_info = json.load(json_file)
                     user_emails.append(user_info["user"]["email"])
                     user_names.append(user_info["user"]["name"])
         # Each group chat is stored in a separate file. We read all of them.
-        for filename in zip_file.namelist():
+        for filename in archive.members("Takeout/Google Chat/Groups"):
             # Read the more finegrained data for each date
-            if filename.startswith("Takeout/Google Chat/Groups/") and filename.endswith("messages.json"):
-                with zip_file.open(filename) as json_file:
+            if filename.endswith("messages.json"):
+                with archive.open(filename) as json_file:
                     data = json.load(json_file)["messages"]
                     for i in range(len(data)):
                         data[i]["chat_group"] = group_index
@@ -784,8 +1554,8 @@ def youtube_watch_history(
 
     # Read the html file with the watch history
     try:
-        with ZipFile(zip_filename) as zip_file:
-            with zip_file.open("Takeout/YouTube and YouTube Music/history/watch-history.html") as file:
+        with _open_archive(zip_filename) as archive:
+            with archive.open("Takeout/YouTube and YouTube Music/history/watch-history.html") as file:
                 html = file.read().decode()
     except KeyError:
         return pd.DataFrame()
@@ -834,6 +1604,50 @@ def youtube_watch_history(
     return df
 
 
+# "Data Source": "..." at the beginning of a Fit data file
+_FIT_DATA_SOURCE = re.compile(rb'"Data Source"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def _scan_fit_data_source(file, chunk_size=4096, max_size=65536):
+    """ Read the "Data Source" of a Fit data file from the beginning of
+    the file. Returns None if it is not found at the top level of the
+    first max_size bytes. """
+    head = b""
+    while len(head) < max_size:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        head += chunk
+        match = _FIT_DATA_SOURCE.search(head)
+        if match:
+            # Only accept the key at the top level, before any list or
+            # nested object
+            before = head[:match.start()].strip()
+            if before != b"{" and (b"[" in before or before.count(b"{") != 1):
+                return None
+            return json.loads(b'"' + match.group(1) + b'"')
+    return None
+
+
+def fit_data_source(zip_filename, data_filename):
+    """ Return the "Data Source" description of a file in the Google Fit
+    All Data folder.
+
+    Only the beginning of the file is read. When called with a
+    TakeoutArchive, the result is cached in the archive.
+    """
+    with _open_archive(zip_filename) as archive:
+        cache = archive.cache.setdefault("fit_data_source", {})
+        if data_filename not in cache:
+            with archive.open(data_filename) as file:
+                data_source = _scan_fit_data_source(file)
+            if data_source is None:
+                with archive.open(data_filename) as file:
+                    data_source = json.load(file)["Data Source"]
+            cache[data_filename] = data_source
+        return cache[data_filename]
+
+
 def fit_list_data(zip_filename):
     """ List data types in the Google Fit All Data folder.
 
@@ -854,20 +1668,17 @@ def fit_list_data(zip_filename):
     all_data_path = "Takeout/Fit/All Data"
 
     try:
-        with ZipFile(zip_filename) as zip_file:
+        with _open_archive(zip_filename) as archive:
             data_types = []
-            for filename in zip_file.namelist():
-                if not filename.startswith(all_data_path):
-                    continue
+            for filename in archive.members(all_data_path):
                 # if the filename contains (NN).json, drop it
                 if re.search(r'\(\d+\).json', filename):
                     continue
                 full_path = filename
                 filename = filename.replace(all_data_path + "/", "")
                 try:
-                    with zip_file.open(full_path) as file:
-                        data = json.load(file)["Data Source"]
-                        data_types.append(filename+":"+data)
+                    data = fit_data_source(archive, full_path)
+                    data_types.append(filename+":"+data)
                 except:
                     continue
     except:
@@ -889,22 +1700,37 @@ def fit_list_data(zip_filename):
     return pd.DataFrame(formatted)
 
 
+# Google Fit data files split into several parts are named
+# filename.json, filename(1).json, ...
+_FIT_DATA_FILE = re.compile(r'^(.*?)(?:\(\d+\))?\.json$')
+
+
+def _fit_data_files(archive):
+    """ Index of the files in the Google Fit All Data folder: filename.json
+    -> the members filename.json and filename(NN).json, in archive order.
+    The index is cached in the archive. """
+    files = archive.cache.get("fit_data_files")
+    if files is None:
+        files = {}
+        for name in archive.members("Takeout/Fit/All Data"):
+            match = _FIT_DATA_FILE.match(name)
+            if match:
+                files.setdefault(match.group(1) + ".json", []).append(name)
+        archive.cache["fit_data_files"] = files
+    return files
+
+
 def fit_expand_data_filename(zip_filename, filename):
     """ List files with names filename(NN).json in the Google Fit All Data folder.
     """
+    all_data_path = "Takeout/Fit/All Data"
     try:
-        with ZipFile(zip_filename) as zip_file:
-            filenames = zip_file.namelist()
+        with _open_archive(zip_filename) as archive:
+            files = _fit_data_files(archive)
     except:
         return pd.DataFrame()
-    
-    all_data_path = "Takeout/Fit/All Data"
-    filename = os.path.join(all_data_path, filename)
-    filename_pattern = filename.replace(".json", r'(.*).json$')
 
-    filenames = [f for f in filenames if f.startswith(all_data_path)]
-    filenames = [f for f in filenames if re.search(filename_pattern, f)]
-    return filenames
+    return list(files.get(os.path.join(all_data_path, filename), []))
 
 
 def fit_read_data_file(
@@ -915,61 +1741,120 @@ def fit_read_data_file(
     """ Read a data file in the Google Fit All Data folder.
     """
     try:
-        with ZipFile(zip_filename) as zip_file:
-            with zip_file.open(data_filename) as file:
-                read_data = json.load(file)
-                data = read_data["Data Points"]
+        with _open_archive(zip_filename) as archive:
+            return _fit_read_zip_data_file(archive, data_filename, timezone)
     except:
         return pd.DataFrame()
-    
-    # normalize
-    data = pd.json_normalize(data)
-    df = pd.DataFrame(data)
-    
-    if df.shape[0] == 0:
-        return df
 
-    def process_unit_value(value):
-        if "fpVal" in value:
-            return float(value["fpVal"])
-        elif "intVal" in value:
-            return int(value["intVal"])
-        elif "stringVal" in value:
-            return value["stringVal"]
-        return value
-
-    def process_fitValue(value, parent_index=None):
-        if type(value) == list:
-            values = []
-            for i, v in enumerate(value):
-                if parent_index is not None:
-                    id = f"{parent_index}_{i}"
-                else:
-                    id = i
-                values += process_fitValue(v, id)
-            return values
-        
-        if type(value) == dict:
-            if "value" in value:
-                id = value.get("key", parent_index)
-                value = value["value"]
-                if "mapVal" in value:
-                    return process_fitValue(value["mapVal"], id)
-                
-                # We are now at bottom level, assuming only
-                # mapVal can be a list
-                value = process_unit_value(value)
-                return [{"id": id, "value": value}]
-
-        raise ValueError("Unknown value type")
 
+def _fit_read_zip_data_file(zip_file, data_filename, timezone):
+    """ Read a Google Fit data file from an open ZipFile or TakeoutArchive.
+    Returns an empty DataFrame if the file can not be read. """
+    try:
+        with zip_file.open(data_filename) as file:
+            data = json.load(file)["Data Points"]
+    except:
+        return pd.DataFrame()
+    return _fit_data_frame(data, timezone)
+
+
+def _fit_unit_value(value):
+    if "fpVal" in value:
+        return float(value["fpVal"])
+    elif "intVal" in value:
+        return int(value["intVal"])
+    elif "stringVal" in value:
+        return value["stringVal"]
+    return value
+
+
+def _flatten_fit_value(value, parent_index, ids, values):
+    """ Append the (id, value) pairs in a fitValue list to ids and values.
+
+    List items are numbered by their position, and map values by their
+    key. Nested positions are joined with "_", e.g. "0_1". """
+    if type(value) == list:
+        for i, v in enumerate(value):
+            if parent_index is not None:
+                id = f"{parent_index}_{i}"
+            else:
+                id = i
+            _flatten_fit_value(v, id, ids, values)
+        return
+
+    if type(value) == dict:
+        if "value" in value:
+            id = value.get("key", parent_index)
+            value = value["value"]
+            if "mapVal" in value:
+                _flatten_fit_value(value["mapVal"], id, ids, values)
+                return
+
+            # We are now at bottom level, assuming only
+            # mapVal can be a list
+            ids.append(id)
+            values.append(_fit_unit_value(value))
+            return
+
+    raise ValueError("Unknown value type")
+
+
+def _flatten_fit_values(data):
+    """ Flatten the fitValue lists of all data points in one pass.
+
+    Returns
+    -------
+    measurement_index : numpy.ndarray
+        The index of the data point of each value
+    ids : numpy.ndarray
+    values : numpy.ndarray
+        Numeric values are returned as int64 or float64 arrays.
+    """
+    measurement_index = []
+    ids = []
+    values = []
+    for i, point in enumerate(data):
+        fit_value = point.get("fitValue")
+        # Fast path for the common single value, e.g. heart rate samples
+        if type(fit_value) == list and len(fit_value) == 1 and type(fit_value[0]) == dict:
+            value = fit_value[0].get("value")
+            if type(value) == dict and "mapVal" not in value:
+                measurement_index.append(i)
+                ids.append(fit_value[0].get("key", 0))
+                values.append(_fit_unit_value(value))
+                continue
+        n = len(ids)
+        if fit_value:
+            _flatten_fit_value(fit_value, None, ids, values)
+        if len(ids) == n:
+            # A data point without values is kept as a row of missing values
+            ids.append(np.nan)
+            values.append(np.nan)
+        measurement_index.extend([i] * (len(ids) - n))
+    measurement_index = np.array(measurement_index, dtype=np.int64)
+    return measurement_index, pd.Series(ids).to_numpy(), pd.Series(values).to_numpy()
+
+
+def _fit_data_frame(data, timezone):
+    """ Convert the data points of a Google Fit data file to a DataFrame.
+
+    The fitValue lists are flattened into one row for each value, with
+    id and value columns. measurement_index is the index of the data
+    point the row comes from.
+    """
+    if len(data) == 0:
+        return pd.DataFrame()
+
+    df = pd.DataFrame(data)
     if "fitValue" in df.columns:
-        df = df.reset_index().rename(columns={'index': 'measurement_index'})
-        df["_fitValue"] = df["fitValue"].apply(process_fitValue)
-        df = df.explode('_fitValue').reset_index(drop=True)
-        new_columns = pd.json_normalize(df['_fitValue'])
-        df = pd.concat([df, new_columns], axis=1)
-        df.drop(["fitValue", "_fitValue"], axis=1, inplace=True)
+        measurement_index, ids, values = _flatten_fit_values(data)
+        df = df.drop(columns="fitValue")
+        if len(measurement_index) != len(df) or (measurement_index != np.arange(len(df))).any():
+            df = df.take(measurement_index)
+        df.reset_index(drop=True, inplace=True)
+        df.insert(0, "measurement_index", measurement_index)
+        df["id"] = ids
+        df["value"] = values
 
     if "startTimeNanos" in df.columns:
         df["timestamp"] = pd.to_datetime(df["startTimeNanos"], unit="ns")
@@ -1001,33 +1886,97 @@ def fit_read_data_file(
     return df
 
     
+# The zip file of a worker process of fit_read_data
+_worker_zip_file = None
+
+
+def _init_fit_worker(zip_filename):
+    """ Open the zip file once in each worker process of fit_read_data.
+    It is closed when the process exits. """
+    global _worker_zip_file
+    _worker_zip_file = ZipFile(zip_filename)
+    multiprocessing.util.Finalize(None, _worker_zip_file.close, exitpriority=0)
+
+
+def _fit_read_data_file_worker(data_filename, timezone):
+    """ Read one data file for fit_read_data (runs in a worker process). """
+    return _fit_read_zip_data_file(_worker_zip_file, data_filename, timezone)
+
+
 def fit_read_data(
         zip_filename,
         data_filename,
-        timezone = "Europe/Helsinki"
+        timezone = "Europe/Helsinki",
+        max_workers = None,
+        processes = None
     ):
     """ Read multiple data files in the Google Fit All Data folder.
+
+    The files are decoded in parallel. Worker threads share the open zip
+    file, and worker processes open it once each. The measurement_index column is renumbered to run
+    over all the files. If no files match, an empty DataFrame with the
+    usual columns is returned.
+
+    Parameters
+    ----------
+    zip_filename : str or TakeoutArchive
+        The filename of the zip file.
+    data_filename : str or list of str
+        Data file names, as in the filename column of fit_list_data.
+    timezone : str, optional
+    max_workers : int, optional
+        Number of parallel workers.
+    processes : bool, optional
+        Decode in a process pool instead of a thread pool. JSON decoding
+        holds the GIL, so processes scale better for large exports. By
+        default, processes are used for zip files on disk and threads
+        for archives opened from file objects, which worker processes
+        can not open.
     """
 
-    if type(data_filename) == str:
-        filenames = fit_expand_data_filename(zip_filename, data_filename)
-    else:
-        try:
-            filenames = []
-            for filename in data_filename:
-                filenames.extend(fit_expand_data_filename(zip_filename, filename))
-        except TypeError:
-            raise ValueError("data_filename should be a string or an iterable containign filename strings.")
-    
-    dfs = []
-    measurement_index = 0
-    for filename in filenames:
-        df = fit_read_data_file(zip_filename, filename)
-        if df.shape[0] == 0:
-            continue
-        df["measurement_index"] += measurement_index
-        measurement_index = df["measurement_index"].max() + 1
-        dfs.append(df)
+    with _open_archive(zip_filename) as archive:
+        if type(data_filename) == str:
+            filenames = fit_expand_data_filename(archive, data_filename)
+        else:
+            try:
+                filenames = []
+                for filename in data_filename:
+                    filenames.extend(fit_expand_data_filename(archive, filename))
+            except TypeError:
+                raise ValueError("data_filename should be a string or an iterable containign filename strings.")
+
+        # Worker processes open the zip file by name, so an archive opened
+        # from a file object is read in threads.
+        on_disk = isinstance(archive.filename, (str, os.PathLike))
+        if processes is None:
+            processes = on_disk
+        parallel = len(filenames) > 1 and max_workers != 1
+        if parallel and processes and on_disk:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_fit_worker,
+                                     initargs=(archive.filename,)) as pool:
+                futures = [pool.submit(_fit_read_data_file_worker, filename, timezone)
+                           for filename in filenames]
+                dfs = [future.result() for future in futures]
+        elif parallel:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = [pool.submit(_fit_read_zip_data_file, archive, filename, timezone)
+                           for filename in filenames]
+                dfs = [future.result() for future in futures]
+        else:
+            dfs = [_fit_read_zip_data_file(archive, filename, timezone) for filename in filenames]
+    dfs = [df for df in dfs if df.shape[0] > 0]
+    if not dfs:
+        return pd.DataFrame(
+            columns=["measurement_index", "id", "value", "end_time", "modified_time", "datatype"],
+            index=pd.DatetimeIndex([], name="timestamp", tz=timezone),
+        )
+
+    # Offset the measurement indices of each file by the number of
+    # measurements in the files before it
+    sizes = [df["measurement_index"].max() + 1 for df in dfs]
+    offsets = np.cumsum([0] + sizes[:-1])
+    for df, offset in zip(dfs, offsets):
+        df["measurement_index"] += offset
 
     df = pd.concat(dfs)
     df.sort_index(inplace=True)
@@ -1035,15 +1984,19 @@ def fit_read_data(
     return df
 
 
-def fit_all_data(zip_filename, timezone = "Europe/Helsinki"):
+def fit_all_data(zip_filename, timezone = "Europe/Helsinki", max_workers = None, processes = None):
     """ Read all the data in the Google Fit All Data folder.
+
+    The data files are decoded in parallel, see fit_read_data.
     """
-    datafiles = fit_list_data(zip_filename)["filename"]
-    data = fit_read_data(zip_filename, datafiles)
+    with _open_archive(zip_filename) as archive:
+        datafiles = fit_list_data(archive)["filename"]
+        data = fit_read_data(archive, datafiles, timezone=timezone,
+                             max_workers=max_workers, processes=processes)
     return data
 
 
-def fit_heart_rate_data(zip_filename, timezone = "Europe/Helsinki"):
+def fit_heart_rate_data(zip_filename, timezone = "Europe/Helsinki", max_workers = None, processes = None):
     """ Read heart rate data from Google Fit All Data folder and
     format it more nicely.
 
@@ -1051,16 +2004,20 @@ def fit_heart_rate_data(zip_filename, timezone = "Europe/Helsinki"):
     ----------
     zip_filename : str
         The filename of the zip file.
+    max_workers, processes :
+        Parallel decoding options, see fit_read_data.
 
     Returns
     -------
     data : pandas.DataFrame
     """
-    entries = fit_list_data(zip_filename)
-    entries = entries[entries["content"].str.contains("heart_rate")]
-    entries = entries[~entries["content"].str.contains("summary")]
-    entries = entries[entries["derived"] == "raw"]
-    df = fit_read_data(zip_filename, entries["filename"])
+    with _open_archive(zip_filename) as archive:
+        entries = fit_list_data(archive)
+        entries = entries[entries["content"].str.contains("heart_rate")]
+        entries = entries[~entries["content"].str.contains("summary")]
+        entries = entries[entries["derived"] == "raw"]
+        df = fit_read_data(archive, entries["filename"], timezone=timezone,
+                           max_workers=max_workers, processes=processes)
 
     df = df[["value", "modified_time"]]
     df.rename(columns={"value": "heart_rate"}, inplace=True)
@@ -1077,12 +2034,9 @@ def fit_sessions(zip_filename, timezone = "Europe/Helsinki"):
 
     data = []
     try:
-        with ZipFile(zip_filename) as zip_file:
-            filenames = zip_file.namelist()
-            for filename in filenames:
-                if not filename.startswith(session_data_path):
-                    continue
-                with zip_file.open(filename) as file:
+        with _open_archive(zip_filename) as archive:
+            for filename in archive.members(session_data_path):
+                with archive.open(filename) as file:
                     session_data = json.load(file)
                     if "segment" in session_data:
                         del session_data["segment"]
@@ -1118,8 +2072,8 @@ def fit_sessions(zip_filename, timezone = "Europe/Helsinki"):
 def myactivity(zip_filename, section, start_date=None, end_date=None):
     data_path = os.path.join("Takeout", "My Activity", section, "MyActivity.html")
 
-    with ZipFile(zip_filename) as zip_file:
-        with zip_file.open(data_path) as file:
+    with _open_archive(zip_filename) as archive:
+        with archive.open(data_path) as file:
             html = file.read().decode()
 
         date_pattern = re.compile(r"(.+?)\s+(\w+\s+\d{1,2},\s+\d{4},\s+\d{1,2}:\d{2}:\d{2}\s+[AP]M\s+\w+)")
@@ -1152,12 +2106,9 @@ def list_myactivity_sections(zip_filename):
     """
     data_path = os.path.join("Takeout", "My Activity")
 
-    with ZipFile(zip_filename) as zip_file:
-        filenames = zip_file.namelist()
+    with _open_archive(zip_filename) as archive:
         sections = set()
-        for filename in filenames:
-            if not filename.startswith(data_path):
-                continue
+        for filename in archive.members(data_path):
             sections.add(filename.split("/")[2])
     return sections
 
@@ -1295,3 +2246,13 @@ def Maps(zip_filename, start_date=None, end_date=None):
 
     return df
 
+
+# The readers are also methods of TakeoutArchive. The archive is passed
+# as the first argument, in place of the zip filename.
+for _reader in [
+        location_history, activity, email_activity, chat, youtube_watch_history,
+        fit_data_source, fit_list_data, fit_expand_data_filename, fit_read_data_file, fit_read_data,
+        fit_all_data, fit_heart_rate_data, fit_sessions, myactivity,
+        list_myactivity_sections, YouTube, PlayStore, app_used, Search, Maps,
+    ]:
+    setattr(TakeoutArchive, _reader.__name__, _reader)
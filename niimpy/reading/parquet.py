@@ -0,0 +1,177 @@
+"""Read and write niimpy data as Parquet files
+
+Parquet is a columnar format, which is much faster to read than CSV or
+sqlite and keeps the data types (including the timezone of the index).
+This is useful for storing preprocessed data for later reuse.
+
+Data can be written to one file, or partitioned into a directory tree
+(Hive style, e.g. 'user=u1/date=2020-01-09/...') so that only the
+needed files are read.  When reading, filters on users and time are
+pushed down to the files and row groups.
+"""
+
+import json
+
+import pandas as pd
+
+from niimpy.preprocessing import util
+
+# Name of the column which stores the DataFrame index in the files
+INDEX_COLUMN = '__niimpy_index__'
+METADATA_KEY = b'niimpy'
+
+
+def write_parquet(df, path, partition_by=None, row_group_size=None):
+    """Write a niimpy DataFrame to Parquet
+
+    The time index (with its timezone), identifier columns and data
+    types are stored so that read_parquet returns the same DataFrame.
+    Data is sorted by time, so that time ranges can be skipped using
+    row group statistics.
+
+    Parameters
+    ----------
+
+    df : pandas.DataFrame
+        Data with a DatetimeIndex
+
+    path : str
+        Filename, or directory name if partition_by is given.
+
+    partition_by : list of str, optional
+        Columns to partition the data by, e.g. ['user', 'date'].
+        'date' is the local date of the index, unless the data has a
+        'date' column.
+
+    row_group_size : int, optional
+        Maximum number of rows in each row group.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = list(df.columns)
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind='stable')
+    df = df.reset_index(names=INDEX_COLUMN)
+    derived = [ ]
+    if partition_by is not None:
+        if isinstance(partition_by, str):
+            partition_by = [partition_by]
+        if 'date' in partition_by and 'date' not in columns:
+            df['date'] = df[INDEX_COLUMN].dt.strftime('%Y-%m-%d')
+            derived.append('date')
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or { })
+    metadata[METADATA_KEY] = json.dumps({'index': INDEX_COLUMN, 'columns': columns, 'derived': derived}).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    if partition_by is None:
+        pq.write_table(table, path, row_group_size=row_group_size)
+    else:
+        pq.write_to_dataset(table, path, partition_cols=partition_by, row_group_size=row_group_size)
+
+
+def _to_timestamp(x, tz):
+    """Convert a start/end argument to a timezone-aware pandas.Timestamp."""
+    if isinstance(x, (int, float)):
+        return pd.Timestamp(x, unit='s', tz='UTC')
+    x = pd.Timestamp(x)
+    if x.tzinfo is None:
+        x = x.tz_localize(tz)
+    return x
+
+
+def read_parquet(path, columns=None, start=None, end=None, users=None, tz=None, categorical_ids=True):
+    """Read niimpy data from Parquet
+
+    Reads data written with write_parquet, from a single file or a
+    partitioned directory.  Only the needed columns are read, and the
+    user and time filters are used to skip partitions and row groups.
+
+    Parameters
+    ----------
+
+    path : str
+        Filename or directory name
+
+    columns : list of str, optional
+        If given, only read these columns.  The identifier columns
+        (user, device, group) are always included.
+
+    start : int or float or str or datetime.datetime, optional
+        If given, only return data from this time on.  Numbers are
+        unixtime, naive times are in the timezone of the data.
+
+    end : int or float or str or datetime.datetime, optional
+        If given, only return data before this time.
+
+    users : list of str, optional
+        If given, only return data of these users.
+
+    tz : str, optional
+        If given, convert the index to this timezone.
+
+    categorical_ids : bool, optional
+        Return the identifier columns (user, device, group) as pandas
+        categoricals (default).  Partition columns are always
+        categorical.
+
+    Returns
+    -------
+
+    df : pandas.DataFrame
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path, format='parquet',
+                         partitioning=ds.HivePartitioning.discover(infer_dictionary=True))
+    schema = dataset.schema
+    metadata = json.loads((schema.metadata or { }).get(METADATA_KEY, b'{}'))
+    index = metadata.get('index')
+    derived = metadata.get('derived', [ ])
+
+    filters = [ ]
+    if users is not None:
+        if isinstance(users, str):
+            users = [users]
+        filters.append(ds.field('user').isin(list(users)))
+    if index is not None and (start is not None or end is not None):
+        index_type = schema.field(index).type
+        data_tz = getattr(index_type, 'tz', None) or tz or util.TZ
+        if start is not None:
+            start = _to_timestamp(start, data_tz)
+            filters.append(ds.field(index) >= pa.scalar(start, type=index_type))
+            if 'date' in derived:
+                filters.append(ds.field('date') >= start.tz_convert(data_tz).strftime('%Y-%m-%d'))
+        if end is not None:
+            end = _to_timestamp(end, data_tz)
+            filters.append(ds.field(index) < pa.scalar(end, type=index_type))
+            if 'date' in derived:
+                filters.append(ds.field('date') <= end.tz_convert(data_tz).strftime('%Y-%m-%d'))
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+
+    read_columns = None
+    if columns is not None:
+        if isinstance(columns, str):
+            columns = [columns]
+        wanted = set(columns) | {'user', 'device', 'group'}
+        read_columns = [c for c in schema.names if c in wanted or c == index]
+
+    df = dataset.to_table(columns=read_columns, filter=expression).to_pandas()
+    if index is not None:
+        df = df.set_index(index)
+        df.index.name = None
+        df = df.sort_index(kind='stable')
+    df = df.drop(columns=[c for c in derived if c in df])
+    if 'columns' in metadata:
+        order = [c for c in metadata['columns'] if c in df]
+        df = df[order + [c for c in df.columns if c not in order]]
+    if tz is not None and isinstance(df.index, pd.DatetimeIndex):
+        df.index = df.index.tz_convert(tz)
+    if categorical_ids:
+        df = util.categorical_identifiers(df)
+    return df
@@ -1,13 +1,19 @@
 """ Read data from sqlite3 database.
 """
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import glob
+import os
 import warnings
 
+import pandas as pd
+
 from niimpy.reading import database
+from niimpy.reading import util as reading_util
 from niimpy.preprocessing import util
 
 
-def read_sqlite(filename, table, add_group=None, user=database.ALL, limit=None, offset=None, start=None, end=None, tz=None):
+def read_sqlite(filename, table, add_group=None, user=database.ALL, limit=None, offset=None, start=None, end=None, tz=None, chunksize=None, columns=None, dtypes=None, categorical_ids=False):
     """Read DataFrame from sqlite3 database
 
     This will read data from a sqlite3 file, taking sensor data in a
@@ -41,16 +47,148 @@ def read_sqlite(filename, table, add_group=None, user=database.ALL, limit=None,
 
     end : int or float or str or datetime.datetime, optional
         Same meaning as 'start', but for end time
+
+    chunksize : int, optional
+        If given, do not read all data at once but return an iterator
+        of DataFrames with at most this many rows each, in time order.
+        Can not be combined with limit or offset.
+
+    columns : list of str, optional
+        If given, only read these columns (and time).
+
+    dtypes : dict, optional
+        Mapping of column name to dtype, used to store the data in
+        compact types.  niimpy.reading.util.AWARE_DTYPES contains types
+        for the standard Aware columns.  Columns not in the data are
+        ignored.
+
+    categorical_ids : bool, optional
+        If true, return the identifier columns (user, device, group) as
+        pandas categoricals, which use less memory and are faster to
+        group by.
     """
     if tz is None:
         warnings.warn(DeprecationWarning("From now on, you should explicitely specify timezone with e.g. tz='Europe/Helsinki'"), stacklevel=2)
 
     db = database.Data1(filename, tz=tz)
-    df = db.raw(table, user, limit=limit, offset=offset, start=start, end=end)
-    df = util.read_preprocess(df, add_group=add_group)
+    if chunksize is not None:
+        if limit is not None or offset is not None:
+            raise ValueError("chunksize can not be combined with limit or offset")
+        return _iter_sqlite(db, table, user, chunksize=chunksize, start=start, end=end, add_group=add_group,
+                            columns=columns, dtypes=dtypes, categorical_ids=categorical_ids)
+    df = db.raw(table, user, limit=limit, offset=offset, start=start, end=end, columns=columns, dtypes=dtypes)
+    df = util.read_preprocess(df, add_group=add_group, categorical_ids=categorical_ids)
     return df
 
 
+def _iter_sqlite(db, table, user, chunksize, start, end, add_group, columns=None, dtypes=None, categorical_ids=False):
+    """Generator behind read_sqlite(chunksize=...)"""
+    for df in db.iter_raw(table, user, chunksize=chunksize, start=start, end=end,
+                          columns=columns, dtypes=dtypes):
+        yield util.read_preprocess(df, add_group=add_group, categorical_ids=categorical_ids)
+
+
+class FILENAME:
+    """Sentinel value: take the user or group from the file name"""
+    pass
+
+
+def _file_value(value, filename):
+    """Resolve an add_user/add_group argument of read_sqlite_many for one file."""
+    basename = os.path.basename(filename)
+    if value is FILENAME:
+        return os.path.splitext(basename)[0]
+    if isinstance(value, dict):
+        for key in (filename, basename, os.path.splitext(basename)[0]):
+            if key in value:
+                return value[key]
+        raise KeyError("File not in the add_user/add_group mapping: {}".format(filename))
+    if callable(value):
+        return value(filename)
+    return value
+
+
+def _read_sqlite_file(filename, table, add_user, add_group, tz, categorical_ids, kwargs):
+    """Read one file for read_sqlite_many (runs in a worker)."""
+    db = database.Data1(filename, tz=tz, read_only=True)
+    df = db.raw(table, **kwargs)
+    return util.read_preprocess(df, add_group=add_group, add_user=add_user, categorical_ids=categorical_ids)
+
+
+def read_sqlite_many(filenames, table, add_user=None, add_group=None, user=database.ALL,
+                     start=None, end=None, tz=None, columns=None, dtypes=None,
+                     max_workers=None, processes=False, categorical_ids=True):
+    """Read the same table from many sqlite3 databases in parallel
+
+    This is meant for studies which store one database per participant.
+    The files are read in a thread (or process) pool, and the results
+    are concatenated into one DataFrame in the order of the files.
+
+    The DataFrames of all files are kept until they are concatenated, so
+    memory use peaks at about twice the size of the result.  The files
+    can have different columns and dtypes, which pd.concat reconciles,
+    so the result is not filled in place.  If this does not fit in
+    memory, read the files in smaller groups, or one at a time with
+    read_sqlite(..., chunksize=...).
+
+    Parameters
+    ----------
+
+    filenames : str or list of str
+        List of database filenames, or a glob pattern such as
+        'data/*.sqlite3'.
+
+    table : str
+        table name of data within the databases
+
+    add_user : object, optional
+        If given, add a 'user' column.  This can be FILENAME (use the
+        file name without extension), a dict of filename (full name,
+        base name or base name without extension) -> user, a function of the filename, or a value used for
+        all files.  A dict must contain all files, otherwise KeyError
+        is raised.
+
+    add_group : object, optional
+        If given, add a 'group' column.  Same options as add_user.
+
+    user, start, end, columns, dtypes :
+        As in read_sqlite, applied to each file.
+
+    max_workers : int, optional
+        Number of parallel workers.
+
+    processes : bool, optional
+        Use a process pool instead of a thread pool.  sqlite reads run
+        in parallel in threads too, but conversion to DataFrames is
+        limited by the GIL.
+
+    categorical_ids : bool, optional
+        Return the identifier columns (user, device, group) as pandas
+        categoricals (default).  Each identifier is stored once, which
+        saves memory when combining many files.
+    """
+    if tz is None:
+        warnings.warn(DeprecationWarning("From now on, you should explicitely specify timezone with e.g. tz='Europe/Helsinki'"), stacklevel=2)
+    if isinstance(filenames, str):
+        filenames = sorted(glob.glob(filenames))
+    filenames = list(filenames)
+    if not filenames:
+        return pd.DataFrame()
+    kwargs = dict(user=user, start=start, end=end, columns=columns, dtypes=dtypes)
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with Executor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_read_sqlite_file, filename, table,
+                               _file_value(add_user, filename), _file_value(add_group, filename),
+                               tz, categorical_ids, kwargs)
+                   for filename in filenames]
+        dfs = [future.result() for future in futures]
+    if categorical_ids:
+        # Shared categories also keep the identifiers categorical in the
+        # result, so that they are not copied as objects
+        dfs = reading_util.union_categories(dfs)
+    return pd.concat(dfs)
+
+
 def read_sqlite_tables(filename):
     """Return names of all tables in this database
 
@@ -1,5 +1,31 @@
 import re
 
+import pandas as pd
+
+# Compact dtypes for the standard Aware columns, to be used as the
+# dtypes= argument of the readers.  Identifiers and other repeated
+# strings become categoricals, status codes small (nullable) integers
+# and measured levels float32.
+AWARE_DTYPES = {
+    'user': 'category',
+    'device': 'category',
+    'group': 'category',
+    'screen_status': 'Int8',
+    'battery_level': 'float32',
+    'battery_status': 'Int8',
+    'battery_health': 'Int8',
+    'battery_adaptor': 'Int8',
+    'is_silent': 'Int8',
+    'double_decibels': 'float32',
+    'double_frequency': 'float32',
+    'call_type': 'category',
+    'call_duration': 'float32',
+    'message_type': 'category',
+    'application_name': 'category',
+    'package_name': 'category',
+    'double_speed': 'float32',
+}
+
 def format_column_names(df):
     # Replace special characters, including space and ., with _
     # (keeping parenthesis and /, which are used in units, e.g. "temperature (C)")
@@ -17,3 +43,20 @@ def set_timezone(df, tz = 'Europe/Helsinki'):
         df.index = df.index.tz_localize(tz)
     return df
 
+
+def union_categories(dfs):
+    """Give categorical columns the same categories in all DataFrames.
+
+    pd.concat only keeps a categorical dtype if the categories are
+    equal, otherwise the result is converted back to objects.
+    """
+    columns = set()
+    for df in dfs:
+        columns.update(c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype))
+    for column in columns:
+        if not all(column in df and isinstance(df[column].dtype, pd.CategoricalDtype) for df in dfs):
+            continue
+        categories = pd.api.types.union_categoricals([df[column].array for df in dfs]).categories
+        for df in dfs:
+            df[column] = df[column].cat.set_categories(categories)
+    return dfs
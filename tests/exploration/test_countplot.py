@@ -13,6 +13,14 @@ def test_get_counts():
     user_counts = countplot.get_counts(df,'user')
     assert (group_counts['values'].values == np.array([3,3,3])).all()
     assert (user_counts['values'].values == np.ones(9)).all()
+
+    # Categorical identifiers only give the groups in the data
+    df['group'] = df['group'].astype('category').cat.add_categories(['unused'])
+    df['user'] = df['user'].astype('category')
+    group_counts = countplot.get_counts(df,'group')
+    assert (group_counts['values'].values == np.array([3,3,3])).all()
+    user_counts = countplot.get_counts(df[df['group'] != 'unused'].iloc[:4],'user')
+    assert (user_counts['values'].values == np.ones(4)).all()
     
 
 def test_calculate_bins():
@@ -47,3 +47,35 @@ def test_aggregate_correct_frequency():
     
     m = res_df.loc[[pd.Timestamp('2022-01-01 00:00:00'), pd.Timestamp('2022-01-01 01:00:00')]].index
     np.testing.assert_array_equal(res_df.index , m)
+
+
+def test_categorical_ids():
+    df = niimpy.read_csv(niimpy.config.MULTIUSER_AWARE_SCREEN_PATH, tz='Europe/Helsinki')
+    df['group'] = 'group1'
+    cat = niimpy.read_csv(niimpy.config.MULTIUSER_AWARE_SCREEN_PATH, tz='Europe/Helsinki',
+                          categorical_ids=True)
+    cat = niimpy.util.read_preprocess(cat, add_group='group1', categorical_ids=True)
+    for column in ['user', 'device', 'group']:
+        assert isinstance(cat[column].dtype, pd.CategoricalDtype)
+
+    # Grouping only returns the combinations present in the data
+    groups = niimpy.util.group_data(cat)['screen_status'].count()
+    expected = niimpy.util.group_data(df)['screen_status'].count()
+    assert len(groups) == len(expected)
+    assert (groups.values == expected.values).all()
+
+    import niimpy.preprocessing.screen as screen
+    expected = screen.extract_features_screen(df)
+    result = screen.extract_features_screen(cat)
+    pd.testing.assert_frame_equal(result.astype({'user': object, 'device': object, 'group': object}),
+                                  expected)
+
+    # The shutdown rows from the battery data have no group, which is
+    # filled with 0 like in non-categorical data
+    bat = niimpy.read_csv(niimpy.config.MULTIUSER_AWARE_BATTERY_PATH, tz='Europe/Helsinki')
+    bat_cat = niimpy.util.categorical_identifiers(bat.copy())
+    expected = screen.util_screen(df.copy(), bat)
+    result = screen.util_screen(cat.copy(), bat_cat)
+    assert (expected['group'] == 0).any()
+    assert len(result) == len(expected)
+    assert (result['group'].astype(object).values == expected['group'].values).all()
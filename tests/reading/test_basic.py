@@ -1,6 +1,9 @@
 import datetime
 import os
+import numpy as np
 import pandas as pd
+import shutil
+import sqlite3
 import time
 
 import pytest
@@ -167,3 +170,322 @@ def test_df_normalize():
     print(df)
     assert df['x']['2018-01-01 03:00:00'] == 3
     assert df.index[1].hour == 3
+
+def test_iter_raw():
+    data = niimpy.open(DATA, tz=TZ)
+    chunks = list(data.iter_raw('AwareScreen', user=niimpy.ALL, chunksize=100, start='2018-07-11', end='2018-07-12'))
+    assert sum(len(chunk) for chunk in chunks) == 163
+    assert [len(chunk) for chunk in chunks] == [100, 63]
+    assert '_niimpy_rowid' not in chunks[0]
+    assert chunks[0].index[-1] <= chunks[1].index[0]
+    # Duplicate timestamps must not be lost at chunk boundaries
+    data = niimpy.open(niimpy.sampledata.MULTIUSER, tz=TZ)
+    chunks = list(data.iter_raw('AwareScreen', user=niimpy.ALL, chunksize=7))
+    assert sum(len(chunk) for chunk in chunks) == len(data.raw('AwareScreen', user=niimpy.ALL))
+
+def test_iter_raw_single_query(tmp_path):
+    db = str(tmp_path / 'multiuser.sqlite3')
+    shutil.copy(niimpy.sampledata.MULTIUSER, db)
+    data = niimpy.open(db, tz=TZ, ensure_indexes=True)
+    # Per-user chunks are read straight from the (user, time) index
+    plans = data.query_plan('AwareScreen', user='jd9INuQ5BBlW')
+    assert not any('TEMP B-TREE' in line for line in plans['iter_raw'])
+    # All pages come from one query, so a sort is never repeated per page
+    statements = [ ]
+    data.conn.set_trace_callback(statements.append)
+    chunks = list(data.iter_raw('AwareScreen', user=niimpy.ALL, chunksize=7))
+    assert len(chunks) > 2
+    assert len([s for s in statements if 'SELECT' in s]) == 1
+    df = pd.concat(chunks)
+    assert df.index.is_monotonic_increasing
+    pd.testing.assert_frame_equal(df, data.raw('AwareScreen', user=niimpy.ALL).sort_index(kind='stable'),
+                                  check_like=True)
+
+def test_optimize(tmp_path):
+    db = str(tmp_path / 'multiuser.sqlite3')
+    shutil.copy(niimpy.sampledata.MULTIUSER, db)
+    data = niimpy.open(db, tz=TZ)
+    assert data.missing_indexes() == {'AwareBattery': ('user', 'time'), 'AwareScreen': ('user', 'time')}
+    plans = data.query_plan('AwareScreen', user='jd9INuQ5BBlW')
+    assert not any('INDEX' in line for line in plans['raw'])
+
+    data = niimpy.open(db, tz=TZ, ensure_indexes=True)
+    assert data.missing_indexes() == {}
+    plans = data.query_plan('AwareScreen', user='jd9INuQ5BBlW', start='2020-01-01')
+    assert any('AwareScreen_user_time' in line for line in plans['raw'])
+    assert data.count('AwareScreen', user=niimpy.ALL)['count'].sum() == 155
+
+def test_optimize_sidecar(tmp_path, monkeypatch):
+    db = str(tmp_path / 'multiuser.sqlite3')
+    shutil.copy(niimpy.sampledata.MULTIUSER, db)
+    monkeypatch.setattr(niimpy.reading.database, '_is_writable', lambda path: False)
+    data = niimpy.open(db, tz=TZ)
+    with pytest.warns(UserWarning):
+        assert data.optimize() == {}
+    assert data.optimize(sidecar=True) == {'AwareBattery': 'AwareBattery_user_time', 'AwareScreen': 'AwareScreen_user_time'}
+    assert os.path.exists(db + '.indexed.sqlite3')
+    assert data.missing_indexes() == {}
+    assert niimpy.open(db, tz=TZ).missing_indexes() != {}
+
+def test_exists():
+    data = niimpy.open(DATA, tz=TZ)
+    assert data.exists('AwareScreen', user=niimpy.ALL) is True
+    assert data.exists('AwareScreen', user=niimpy.ALL, start="2018-07-25") is False
+    data = niimpy.open(niimpy.sampledata.MULTIUSER, tz=TZ)
+    assert data.exists('AwareScreen', user='jd9INuQ5BBlW') is True
+    assert data.exists('AwareScreen', user='nobody') is False
+
+def test_bound_parameters():
+    data = niimpy.open(DATA, tz=TZ)
+    sql_a, params_a = data._query_raw('AwareScreen', niimpy.ALL, start="2018-07-11", end="2018-07-12")
+    sql_b, params_b = data._query_raw('AwareScreen', niimpy.ALL, start=1531256400, end=1531342800)
+    # The same statement is reused with different values
+    assert sql_a == sql_b
+    assert params_a['start'] == params_b['start']
+    # min/max are answered directly from the time index
+    plans = data.query_plan('AwareScreen', start="2018-07-11", end="2018-07-12")
+    assert any('INDEX AwareScreen_time' in line for line in plans['first'])
+    assert data.first('AwareScreen', user=niimpy.ALL, start="2018-07-11")['time'][0] >= 1531256400
+    assert data.last('AwareScreen', user=niimpy.ALL, end="2018-07-12")['time'][0] < 1531342800
+
+def test_raw_many():
+    data = niimpy.open(niimpy.sampledata.MULTIUSER, tz=TZ, read_only=True, immutable=True,
+                       mmap_size=2**20, cache_size=-2000)
+    assert data.conn.execute('PRAGMA mmap_size').fetchone()[0] == 2**20
+    users = sorted(data.users('AwareScreen'))
+    dfs = data.raw_many('AwareScreen', users, max_workers=4, concat=False)
+    assert set(dfs) == set(users)
+    for user in users:
+        pd.testing.assert_frame_equal(dfs[user], data.raw('AwareScreen', user))
+    df = data.raw_many('AwareScreen', users, max_workers=4)
+    assert len(df) == len(data.raw('AwareScreen', niimpy.ALL))
+    assert list(df['user'].unique()) == users
+    with pytest.raises(sqlite3.OperationalError):
+        data.execute('CREATE TABLE test (x)')
+
+def test_hourly_columns():
+    data = niimpy.open(niimpy.sampledata.MULTIUSER, tz=TZ)
+    hourly = data.hourly('AwareBattery', user=niimpy.ALL, columns=['battery_level', 'battery_status'])
+    raw = data.raw('AwareBattery', niimpy.ALL)
+    level = pd.to_numeric(raw['battery_level']).groupby(raw.index.floor('h'))
+    assert (hourly.index == level.mean().index).all()
+    assert np.allclose(hourly['battery_level_mean'], level.mean())
+    assert np.allclose(hourly['battery_level_std'], level.std(ddof=0))
+    assert (hourly['battery_level_count'] == level.count()).all()
+    assert (hourly['count'] == level.size()).all()
+    assert (hourly['user'] == 'jd9INuQ5BBlW').all()
+    assert list(hourly.columns[:4]) == ['user', 'day', 'hour', 'count']
+
+def test_hourly_occurrence_sql_equivalence(tmp_path):
+    # The numpy hourly() and occurrence() give the same numbers as the
+    # previous implementation, which grouped in sqlite with
+    # strftime(..., 'localtime') (TZ is set above) and the stdev aggregate.
+    # Copy of the data with numeric values: the pure Python stdev
+    # aggregate ignores values stored as text.
+    db = str(tmp_path / 'numeric.sqlite3')
+    df = niimpy.open(niimpy.sampledata.MULTIUSER, tz=TZ).raw('AwareBattery', niimpy.ALL)
+    df = df[['user', 'time', 'battery_level', 'battery_status']]
+    df = df.astype({'battery_level': float, 'battery_status': float})
+    df.loc[df.index[::7], 'battery_level'] = None
+    conn = sqlite3.connect(db)
+    df.to_sql('AwareBattery', conn, index=False)
+    conn.create_aggregate("stdev", 1, niimpy.reading.database.sqlite3_stdev)
+    user = 'jd9INuQ5BBlW'
+
+    slow = pd.read_sql("""SELECT
+                              strftime('%Y-%m-%d', time, 'unixepoch', 'localtime') AS day,
+                              CAST(strftime('%H', time, 'unixepoch', 'localtime') AS INTEGER) AS hour,
+                              count(*) as count,
+                              avg(battery_level) AS battery_level_mean, stdev(battery_level) AS battery_level_std,
+                              count(battery_level) AS battery_level_count
+                          FROM AwareBattery WHERE user=:user
+                          GROUP BY day, hour ORDER BY day, hour""", conn, params={'user': user})
+    data = niimpy.open(db, tz=TZ)
+    fast = data.hourly('AwareBattery', user, columns=['battery_level'])
+    assert list(fast['day']) == list(slow['day'])
+    assert list(fast['hour']) == list(slow['hour'])
+    for c in ['count', 'battery_level_mean', 'battery_level_std', 'battery_level_count']:
+        assert np.allclose(fast[c], slow[c], equal_nan=True), c
+
+    slow = pd.read_sql("""SELECT day, hour,
+                              count(*) as occurrence, sum(bin_count) as count, group_concat(interval) AS withdata
+                          FROM (
+                              SELECT
+                                strftime('%Y-%m-%d', time, 'unixepoch', 'localtime') AS day,
+                                CAST(strftime('%H', time, 'unixepoch', 'localtime') AS INTEGER) AS hour,
+                                CAST(strftime('%M', time, 'unixepoch', 'localtime')/12 AS INTEGER) AS interval,
+                                count(*) as bin_count
+                               FROM AwareBattery WHERE user=:user
+                               GROUP BY day, hour, interval
+                              )
+                          GROUP BY day, hour ORDER BY day, hour""", conn, params={'user': user})
+    conn.close()
+    fast = data.occurrence('AwareBattery', user)
+    assert list(fast['day']) == list(slow['day'])
+    assert list(fast['hour']) == list(slow['hour'])
+    assert list(fast['occurrence']) == list(slow['occurrence'])
+    assert list(fast['count']) == list(slow['count'])
+    assert [sorted(w.split(',')) for w in fast['withdata']] == [sorted(w.split(',')) for w in slow['withdata']]
+
+    # limit and offset select the earliest data points
+    times = data.raw('AwareBattery', user).sort_values('time')['time']
+    limited = data.hourly('AwareBattery', user, limit=5, offset=2)
+    assert limited['count'].sum() == 5
+    assert limited.index[0] == pd.to_datetime(times.iloc[2], unit='s', utc=True).tz_convert(TZ).floor('h')
+
+def test_occurrence_timezone(tmp_path):
+    # Times around the end of daylight saving time in Helsinki:
+    # 2018-10-28 03:00-04:00 local time happens twice.
+    db = str(tmp_path / 'dst.sqlite3')
+    conn = sqlite3.connect(db)
+    times = [1540684800 + 60*i for i in range(0, 180, 5)]
+    pd.DataFrame({'time': times}).to_sql('AwareScreen', conn, index=False)
+    conn.close()
+
+    data = niimpy.open(db, tz=TZ)
+    occs = data.occurrence('AwareScreen', user=niimpy.ALL)
+    assert list(occs['hour']) == [3, 3, 4]
+    assert list(occs['count']) == [12, 12, 12]
+    assert list(occs['occurrence']) == [5, 5, 5]
+    assert occs['withdata'].iloc[0] == '0,1,2,3,4'
+    assert occs.index.is_unique
+    assert occs.index[0].utcoffset() != occs.index[1].utcoffset()
+
+    # The result does not depend on the timezone of the computer
+    data = niimpy.open(db, tz='America/New_York')
+    occs = data.occurrence('AwareScreen', user=niimpy.ALL)
+    assert list(occs['hour']) == [20, 21, 22]
+    assert str(occs.index.tz) == 'America/New_York'
+
+def test_metadata_cache(tmp_path):
+    db = str(tmp_path / 'multiuser.sqlite3')
+    shutil.copy(niimpy.sampledata.MULTIUSER, db)
+    data = niimpy.open(db, tz=TZ)
+    counts = data.user_table_counts()
+    data.users()
+    assert counts.loc['AwareScreen', 'jd9INuQ5BBlW'] == 155
+    assert counts.loc['AwareBattery', 'jd9INuQ5BBlW'] == 373
+
+    # Opening the unchanged file again does not run any queries
+    statements = []
+    data = niimpy.open(db, tz=TZ)
+    data.conn.set_trace_callback(statements.append)
+    assert data.tables() == {'AwareScreen', 'AwareBattery'}
+    assert data.users() == {'jd9INuQ5BBlW'}
+    pd.testing.assert_frame_equal(data.user_table_counts(), counts)
+    assert statements == []
+
+    # Changing the file invalidates the cache
+    conn = sqlite3.connect(db)
+    conn.execute('INSERT INTO AwareScreen (user, time) VALUES ("new_user", 0)')
+    conn.commit()
+    conn.close()
+    data = niimpy.open(db, tz=TZ)
+    assert data.users() == {'jd9INuQ5BBlW', 'new_user'}
+    assert data.user_table_counts().loc['AwareScreen', 'new_user'] == 1
+
+def test_metadata_cache_wal(tmp_path):
+    db = str(tmp_path / 'multiuser.sqlite3')
+    shutil.copy(niimpy.sampledata.MULTIUSER, db)
+    writer = sqlite3.connect(db)
+    writer.execute('PRAGMA journal_mode=WAL')
+    data = niimpy.open(db, tz=TZ)
+    assert data.users() == {'jd9INuQ5BBlW'}
+
+    # Writes in WAL mode do not change the database file itself
+    stat = os.stat(db)
+    writer.execute('INSERT INTO AwareScreen (user, time) VALUES ("new_user", 0)')
+    writer.commit()
+    assert os.stat(db).st_mtime_ns == stat.st_mtime_ns
+    data = niimpy.open(db, tz=TZ)
+    assert data.users() == {'jd9INuQ5BBlW', 'new_user'}
+    writer.close()
+
+def test_query_cache(tmp_path):
+    db = str(tmp_path / 'multiuser.sqlite3')
+    shutil.copy(niimpy.sampledata.MULTIUSER, db)
+    data = niimpy.open(db, tz=TZ, cache=True)
+    df = data.raw('AwareScreen', niimpy.ALL, start='2020-01-09')
+    df['screen_status'] = 'modified'
+    df2 = data.raw('AwareScreen', niimpy.ALL, start='2020-01-09')
+    assert (df2['screen_status'] != 'modified').all()
+    data.hourly('AwareScreen', niimpy.ALL)
+    data.hourly('AwareScreen', niimpy.ALL, limit=None)
+    assert data.cache.cache_info() == dict(hits=2, misses=2, size=2, maxsize=128)
+
+    # Changing the file invalidates results
+    conn = sqlite3.connect(db)
+    conn.execute('INSERT INTO AwareScreen (user, time) VALUES ("new_user", 1578528401)')
+    conn.commit()
+    conn.close()
+    df3 = data.raw('AwareScreen', niimpy.ALL, start='2020-01-09')
+    assert len(df3) == len(df2) + 1
+    assert data.cache.cache_info()['misses'] == 3
+
+    # Results on disk are shared between caches
+    cache_dir = str(tmp_path / 'cache')
+    data = niimpy.open(db, tz=TZ, cache=niimpy.reading.database.QueryCache(directory=cache_dir))
+    df = data.occurrence('AwareScreen', niimpy.ALL)
+    data = niimpy.open(db, tz=TZ, cache=niimpy.reading.database.QueryCache(directory=cache_dir))
+    df2 = data.occurrence('AwareScreen', niimpy.ALL)
+    assert data.cache.cache_info()['hits'] == 1
+    pd.testing.assert_frame_equal(df, df2)
+
+def test_query_cache_wal(tmp_path):
+    db = str(tmp_path / 'multiuser.sqlite3')
+    shutil.copy(niimpy.sampledata.MULTIUSER, db)
+    writer = sqlite3.connect(db)
+    writer.execute('PRAGMA journal_mode=WAL')
+    cache_dir = str(tmp_path / 'cache')
+    data = niimpy.open(db, tz=TZ, cache=niimpy.reading.database.QueryCache(directory=cache_dir))
+    df = data.raw('AwareScreen', niimpy.ALL)
+    hourly = data.hourly('AwareScreen', niimpy.ALL)
+
+    writer.execute('INSERT INTO AwareScreen (user, time) VALUES ("new_user", 1578528401)')
+    writer.commit()
+    assert len(data.raw('AwareScreen', niimpy.ALL)) == len(df) + 1
+    assert data.hourly('AwareScreen', niimpy.ALL)['count'].sum() == hourly['count'].sum() + 1
+    # Also for results stored on disk
+    data = niimpy.open(db, tz=TZ, cache=niimpy.reading.database.QueryCache(directory=cache_dir))
+    assert len(data.raw('AwareScreen', niimpy.ALL)) == len(df) + 1
+    writer.close()
+
+def test_window():
+    data = niimpy.open(niimpy.sampledata.MULTIUSER, tz=TZ)
+    window = data.window('2020-01-09 12:00', '2020-01-09 18:00', user='jd9INuQ5BBlW',
+                         columns={'AwareScreen': ['screen_status']})
+    assert set(window) == {'AwareScreen', 'AwareBattery'}
+    battery = data.raw('AwareBattery', 'jd9INuQ5BBlW', start='2020-01-09 12:00', end='2020-01-09 18:00')
+    pd.testing.assert_frame_equal(window['AwareBattery'], battery)
+    assert list(window['AwareScreen'].columns) == ['time', 'screen_status', 'datetime']
+    assert (window['AwareScreen'].index >= pd.Timestamp('2020-01-09 12:00', tz=TZ)).all()
+    assert (window['AwareScreen'].index < pd.Timestamp('2020-01-09 18:00', tz=TZ)).all()
+    assert not data.conn.in_transaction
+
+    window = data.window(1578528000, 1578614400, tables=['AwareScreen'])
+    assert len(window['AwareScreen']) == 155
+
+def test_window_query_cache(tmp_path):
+    db = str(tmp_path / 'multiuser.sqlite3')
+    shutil.copy(niimpy.sampledata.MULTIUSER, db)
+    data = niimpy.open(db, tz=TZ, cache=True)
+    data.raw('AwareScreen', niimpy.ALL, start=1578528000, end=1578614400)
+    # Cached results are not mixed into the snapshot
+    window = data.window(1578528000, 1578614400, tables=['AwareScreen'])
+    assert len(window['AwareScreen']) == 155
+    assert data.cache.cache_info()['hits'] == 0
+
+def test_df_normalize_day_hour():
+    df = pd.DataFrame({'day': ['2018-10-27', '2018-10-28', '2018-10-28'], 'hour': [23, 2, 5], 'x': [1, 2, 3]})
+    expected = [pd.Timestamp('%s %s:00'%(d, h)) for d, h in zip(df['day'], df['hour'])]
+    niimpy.util.df_normalize(df, tz=TZ, old_tz='UTC')
+    assert list(df.index) == [pd.Timestamp(t, tz='UTC').tz_convert(TZ) for t in expected]
+
+    # Times which do not exist in the timezone still raise
+    df = pd.DataFrame({'day': ['2018-03-25'], 'hour': [3]})
+    with pytest.raises(Exception):
+        niimpy.util.df_normalize(df, tz=TZ)
+
+    df = pd.DataFrame({'day': [], 'hour': []})
+    niimpy.util.df_normalize(df, tz=TZ)
+    assert len(df.index) == 0
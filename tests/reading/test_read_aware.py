@@ -0,0 +1,38 @@
+import gzip
+import shutil
+
+import pandas as pd
+
+import niimpy
+from niimpy import config
+import niimpy.preprocessing.screen as screen
+
+TZ = 'Europe/Helsinki'
+
+
+def test_read_aware_directory(tmp_path):
+    (tmp_path / 'part2').mkdir()
+    shutil.copy(config.MULTIUSER_AWARE_SCREEN_PATH, tmp_path / 'multiuser_AwareScreen.csv')
+    shutil.copy(config.MULTIUSER_AWARE_BATTERY_PATH, tmp_path / 'AwareBattery_1.csv')
+    with open(config.MULTIUSER_AWARE_BATTERY_PATH, 'rb') as f:
+        with gzip.open(tmp_path / 'part2' / 'AwareBattery_2.csv.gz', 'wb') as out:
+            shutil.copyfileobj(f, out)
+    (tmp_path / 'AwareBattery_notes.txt').write_text('not data')
+
+    files = niimpy.reading.aware.find_sensor_files(str(tmp_path), ['AwareScreen', 'awarebattery', 'AwareCalls'])
+    assert sorted(files) == ['AwareScreen', 'awarebattery']
+    assert len(files['awarebattery']) == 2
+
+    data = niimpy.read_aware_directory(str(tmp_path), ['AwareScreen', 'AwareBattery'], tz=TZ, max_workers=2)
+    assert sorted(data) == ['AwareBattery', 'AwareScreen']
+    expected = niimpy.read_csv(config.MULTIUSER_AWARE_SCREEN_PATH, tz=TZ, categorical_ids=True)
+    pd.testing.assert_frame_equal(data['AwareScreen'], expected)
+    battery = niimpy.read_csv(config.MULTIUSER_AWARE_BATTERY_PATH, tz=TZ)
+    assert len(data['AwareBattery']) == 2 * len(battery)
+    assert isinstance(data['AwareBattery']['user'].dtype, pd.CategoricalDtype)
+
+    features = screen.extract_features_screen(data['AwareScreen'], data['AwareBattery'].iloc[:len(battery)])
+    assert len(features) > 0
+
+    data = niimpy.read_aware_directory(str(tmp_path), tz=TZ, processes=False)
+    assert sorted(data) == ['AwareBattery_1', 'AwareBattery_2', 'multiuser_AwareScreen']
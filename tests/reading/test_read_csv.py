@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import numpy as np
 
@@ -14,3 +15,38 @@ def test_read_csv():
     assert isinstance(data.index, pd.DatetimeIndex)
     # There should be a column 'datetime' added in the setup.
     assert 'datetime' in data
+
+
+def test_read_csv_columns_dtypes():
+    data = niimpy.read_csv(config.MULTIUSER_AWARE_BATTERY_PATH, tz=TZ,
+                           columns=['user', 'battery_level', 'battery_status'],
+                           dtypes=niimpy.reading.util.AWARE_DTYPES)
+    assert set(data.columns) == {'time', 'user', 'battery_level', 'battery_status', 'datetime'}
+    assert data['user'].dtype == 'category'
+    assert data['battery_level'].dtype == 'float32'
+    assert data['battery_status'].dtype == 'Int8'
+
+
+def test_read_csv_chunksize():
+    filename = os.path.join(config.ROOT, 'sampledata', 'AwareScreen_1month.csv.gz')
+    data = niimpy.read_csv(filename, tz=TZ)
+    for engine in [None, 'pyarrow']:
+        chunks = list(niimpy.read_csv(filename, tz=TZ, chunksize=1000, engine=engine,
+                                      columns=['screen_status'], dtypes=niimpy.reading.util.AWARE_DTYPES))
+        assert all(len(chunk) == 1000 for chunk in chunks[:-1])
+        assert 0 < len(chunks[-1]) <= 1000
+        assert all(str(chunk.index.tz) == TZ for chunk in chunks)
+        combined = pd.concat(chunks)
+        assert combined['screen_status'].dtype == 'Int8'
+        assert (combined.index == data.index).all()
+        assert (combined['screen_status'] == data['screen_status']).all()
+
+
+def test_read_csv_pyarrow():
+    data = niimpy.read_csv(config.MULTIUSER_AWARE_BATTERY_PATH, tz=TZ, engine='pyarrow',
+                           columns=['user', 'battery_level'], dtypes=niimpy.reading.util.AWARE_DTYPES)
+    expected = niimpy.read_csv(config.MULTIUSER_AWARE_BATTERY_PATH, tz=TZ,
+                               columns=['user', 'battery_level'], dtypes=niimpy.reading.util.AWARE_DTYPES)
+    assert data['user'].dtype == 'category'
+    assert data['battery_level'].dtype == 'float32'
+    pd.testing.assert_frame_equal(data[expected.columns], expected, check_categorical=False)
@@ -1,3 +1,9 @@
+import contextlib
+import datetime
+import email
+import inspect
+import io
+import json
 import pandas as pd
 import numpy as np
 import pytest
@@ -75,6 +81,56 @@ def test_read_location_activity_threshold(google_takeout_zipped):
     assert data['activity_inference_confidence']["2016-08-12T19:30:49.531Z"].iloc[2] == 8
 
 
+def test_read_location_columns(google_takeout_zipped):
+    """test reading selected location columns directly into arrays."""
+    columns = ["latitude", "longitude", "accuracy", "altitude", "source", "device",
+               "activity_type", "activity_inference_confidence", "inferred_latitude"]
+    data = niimpy.reading.google_takeout.location_history(google_takeout_zipped, user="u", columns=columns)
+    expected = niimpy.reading.google_takeout.location_history(google_takeout_zipped, user="u")
+    assert list(data.columns) == columns + ["user"]
+    pd.testing.assert_frame_equal(data, expected[columns + ["user"]], check_dtype=False)
+
+    data = niimpy.reading.google_takeout.location_history(
+        google_takeout_zipped,
+        columns=["latitude"],
+        start_date=pd.to_datetime("2016-08-12T19:31:00.00Z", format='ISO8601'),
+        end_date=pd.to_datetime("2016-08-12T21:16:34.00Z", format='ISO8601'),
+    )
+    assert data.shape == (3, 2)
+
+    data = niimpy.reading.google_takeout.location_history(
+        google_takeout_zipped, inferred_activity="all", columns=["activity_type"]
+    )
+    assert list(data.columns) == ["activity_type", "user"]
+
+    with pytest.raises(ValueError):
+        niimpy.reading.google_takeout.location_history(google_takeout_zipped, columns=["wifi"])
+
+
+def test_iter_json_list():
+    records = [
+        {"timestamp": "2016-08-12T19:31:00Z", "name": "ä { \" [ }"},
+        {"timestamp": "2016-08-12T19:31:00.500Z", "nested": [{"a": 1}, {"b": [2, 3]}]},
+        {"timestamp": "2016-08-12T19:30:59.999Z"},
+        {"timestamp": "2016-08-12T21:31:00+02:00"},
+    ]
+    content = json.dumps({"other": {"x": 1}, "locations": records}).encode()
+    for chunk_size in [1, 7, 1 << 20]:
+        items = list(niimpy.reading.google_takeout.iter_json_list(io.BytesIO(content), "locations", chunk_size=chunk_size))
+        assert items == records
+
+    start_date = pd.Timestamp("2016-08-12T19:31:00Z")
+    with tempfile.TemporaryDirectory() as ddir:
+        zip_filename = os.path.join(ddir, "test.zip")
+        with zipfile.ZipFile(zip_filename, mode="w") as zip_file:
+            zip_file.writestr("Records.json", content)
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            data = niimpy.reading.google_takeout.read_json_after_timestamp(zip_file, "Records.json", start_date)
+    expected = [r for r in records if pd.to_datetime(r["timestamp"], format='ISO8601') > start_date]
+    assert data == expected
+    assert len(data) == 1
+
+
 def test_read_location_no_location_data(empty_zip_file):
     """test reading location data not present in file. """
     data = niimpy.reading.google_takeout.location_history(empty_zip_file)
@@ -225,6 +281,162 @@ def test_read_email_activity_end_date(google_takeout_zipped, request):
         assert data.shape == (1, 11)
 
 
+def test_read_email_activity_sentiment_by_position(google_takeout_zipped, monkeypatch):
+    """ test that sentiments are joined to the right messages. """
+    batches = []
+    def get_sentiment(contents):
+        batches.append(len(contents))
+        return [{"label": "positive", "score": len(content)} for content in contents]
+    monkeypatch.setattr(niimpy.reading.google_takeout, "get_sentiment", get_sentiment)
+
+    with pytest.warns(UserWarning):
+        data = niimpy.reading.google_takeout.email_activity(
+            google_takeout_zipped, sentiment=True, sentiment_batch_size=2
+        )
+    assert data.shape == (5, 13)
+    assert (data["sentiment"] == "positive").all()
+    assert (data["sentiment_score"] == data["character_count"]).all()
+    assert max(batches) == 2
+
+
+def test_read_email_activity_sentiment_reads_once(google_takeout_zipped, monkeypatch):
+    """ test that the mailbox is opened and read only once. """
+    monkeypatch.setattr(niimpy.reading.google_takeout, "get_sentiment",
+                        lambda contents: [{"label": "positive", "score": 1.0} for _ in contents])
+    opens = []
+    open_mbox = niimpy.reading.google_takeout._open_mbox
+
+    class CountingFile:
+        def __init__(self, f):
+            self.f = f
+            self.read_bytes = 0
+
+        def read(self, size=-1):
+            data = self.f.read(size)
+            self.read_bytes += len(data)
+            return data
+
+    @contextlib.contextmanager
+    def counting_open_mbox(filename):
+        with open_mbox(filename) as f:
+            opens.append(CountingFile(f))
+            yield opens[-1]
+    monkeypatch.setattr(niimpy.reading.google_takeout, "_open_mbox", counting_open_mbox)
+
+    with pytest.warns(UserWarning):
+        data = niimpy.reading.google_takeout.email_activity(
+            google_takeout_zipped, sentiment=True, sentiment_batch_size=2
+        )
+    assert data.shape == (5, 13)
+    assert len(opens) == 1
+    with zipfile.ZipFile(google_takeout_zipped) as zip_file:
+        size = zip_file.getinfo(niimpy.reading.google_takeout.MBOX_INTERNAL_FILENAME).file_size
+    assert opens[0].read_bytes == size
+
+
+def test_read_email_activity_sentiment_error(google_takeout_zipped, monkeypatch):
+    """ test that errors in sentiment analysis reach the caller. """
+    def get_sentiment(contents):
+        raise ImportError("no sentiment")
+    monkeypatch.setattr(niimpy.reading.google_takeout, "get_sentiment", get_sentiment)
+
+    with pytest.warns(UserWarning), pytest.raises(ImportError):
+        niimpy.reading.google_takeout.email_activity(
+            google_takeout_zipped, sentiment=True, sentiment_batch_size=100
+        )
+
+
+def test_read_email_activity_headers_only(google_takeout_zipped):
+    with pytest.warns(UserWarning):
+        data = niimpy.reading.google_takeout.email_activity(google_takeout_zipped, content_stats=False)
+    assert data.shape == (5, 9)
+    assert "word_count" not in data.columns
+    assert data.iloc[3]["in_reply_to"] == data.iloc[0]["message_id"]
+
+    # Counts over several parts are equal to counting the joined content
+    message = email.message_from_string(
+        'Content-Type: multipart/mixed; boundary="XX"\n\n'
+        "--XX\nContent-Type: text/plain\n\nsplit wo\n"
+        "--XX\nContent-Type: text/plain\n\nrd here \n"
+        "--XX--\n"
+    )
+    content = niimpy.reading.google_takeout.email_utils.extract_content(message)
+    counts = niimpy.reading.google_takeout._content_counts(message)
+    assert counts == (len(content), len(content.split()))
+
+
+def test_email_mbox_index(tmp_path, monkeypatch):
+    """ test the message index and parallel parsing on a larger mailbox. """
+    messages = []
+    for i in range(1500):
+        minute = i % 60
+        messages.append(
+            f"From {i}@xxx Sat Dec 15 12:{minute:02d}:00 +0000 2023\n"
+            f"From: <user{i % 3}@example.com>\n"
+            f"To: <user{(i + 1) % 3}@example.com>\n"
+            f"Date: Sat, 15 Dec 2023 12:{minute:02d}:00 +0000\n"
+            f"Message-ID: <{i}@example.com>\n"
+            f"\n"
+            f"Message number {i}\n"
+            f">From the body\n"
+        )
+    path = str(tmp_path / "mail.mbox")
+    with open(path, "w") as f:
+        f.write("".join(messages))
+
+    # Separators and headers split between chunks
+    with open(path, "rb") as f:
+        offsets, lengths, dates = niimpy.reading.google_takeout._scan_mbox(f, chunk_size=7)
+    assert len(offsets) == 1500
+    assert lengths[10] == len(messages[10])
+    assert dates[10] == "Sat, 15 Dec 2023 12:10:00 +0000"
+
+    # The index is only stored if requested
+    index = niimpy.reading.google_takeout.mbox_index(path)
+    assert os.listdir(tmp_path) == ["mail.mbox"]
+    assert index["offset"].tolist() == offsets
+    assert index["timestamp"][10] == pd.to_datetime("2023-12-15 12:10:00+00:00")
+
+    serial = niimpy.reading.google_takeout.email_activity(path, pseudonymize=False, user="u", max_workers=1)
+    parallel = niimpy.reading.google_takeout.email_activity(path, pseudonymize=False, user="u", max_workers=2)
+    assert serial.shape == (1500, 11)
+    pd.testing.assert_frame_equal(serial, parallel)
+
+    # The index is stored while the messages are read, and then reused
+    # without scanning the mailbox
+    def scan(*args, **kwargs):
+        raise AssertionError("The mailbox was scanned separately")
+    monkeypatch.setattr(niimpy.reading.google_takeout, "_scan_mbox", scan)
+    index_file = str(tmp_path / "mail.index.json")
+    data = niimpy.reading.google_takeout.email_activity(
+        path, pseudonymize=False, user="u", max_workers=1, index_file=index_file
+    )
+    pd.testing.assert_frame_equal(data, serial)
+    assert os.path.exists(index_file)
+    start_date = pd.to_datetime("2023-12-15 12:50:00+00:00")
+    data = niimpy.reading.google_takeout.email_activity(
+        path, pseudonymize=False, user="u", start_date=start_date, index_file=index_file
+    )
+    assert len(data) == 250
+    assert (data.index >= start_date).all()
+
+    # Naive dates are in the niimpy timezone
+    with niimpy.util.tmp_timezone("Europe/Helsinki"):
+        data = niimpy.reading.google_takeout.email_activity(
+            path, pseudonymize=False, user="u", start_date=datetime.datetime(2023, 12, 15, 14, 50)
+        )
+    assert len(data) == 250
+
+    # The index can not be stored for archives opened from file objects
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        zip_file.write(path, niimpy.reading.google_takeout.MBOX_INTERNAL_FILENAME)
+    with niimpy.reading.google_takeout.TakeoutArchive(buffer) as archive:
+        assert len(archive.email_activity(pseudonymize=False, max_workers=1)) == 1500
+        with pytest.raises(ValueError):
+            archive.email_activity(index_file=index_file)
+
+
 def test_read_email_unknown_file():
     with pytest.raises(ValueError):
         niimpy.reading.google_takeout.email_activity("unknown_file")
@@ -395,6 +607,28 @@ def test_fit_read_data_with_mapdata(google_takeout_zipped):
     assert data.shape == (39, 6)
 
 
+def test_fit_flatten_values():
+    points = [
+        {"startTimeNanos": 1, "fitValue": [{"value": {"fpVal": 65}}]},
+        {"startTimeNanos": 2, "fitValue": [{"value": {"intVal": 1}}, {"value": {"stringVal": "a"}}]},
+        {"startTimeNanos": 3, "fitValue": [{"value": {"mapVal": [
+            {"key": "fat", "value": {"fpVal": 3.5}},
+            {"key": "meal", "value": {"mapVal": [{"value": {"intVal": 4}}]}},
+        ]}}]},
+        {"startTimeNanos": 4, "fitValue": []},
+    ]
+    df = niimpy.reading.google_takeout._fit_data_frame(points, "Europe/Helsinki")
+    assert list(df["measurement_index"]) == [0, 1, 1, 2, 2, 3]
+    assert list(df["id"][:5]) == [0, 0, 1, "fat", "meal_0"]
+    assert list(df["value"][:5]) == [65.0, 1, "a", 3.5, 4]
+    assert np.isnan(df["value"].iloc[5])
+
+    heart_rate = [{"startTimeNanos": i, "fitValue": [{"value": {"fpVal": 60 + i}}]} for i in range(5)]
+    df = niimpy.reading.google_takeout._fit_data_frame(heart_rate, "Europe/Helsinki")
+    assert df["value"].dtype == np.float64
+    assert list(df["measurement_index"]) == list(range(5))
+
+
 def test_fit_read_data(google_takeout_zipped):
     data = niimpy.reading.google_takeout.fit_read_data(
         google_takeout_zipped,
@@ -416,6 +650,102 @@ def test_fit_heart_rate_data(google_takeout_zipped):
     assert data.shape == (10, 2)
 
 
+def test_takeout_archive(google_takeout_zipped, monkeypatch):
+    google_takeout = niimpy.reading.google_takeout
+    with google_takeout.TakeoutArchive(google_takeout_zipped) as archive:
+        assert len(archive.members("Takeout/Fit/All Data")) == 11
+        assert archive.members("Takeout/Fit/All Data/") == archive.members("Takeout/Fit/All Data")
+        assert archive.members("Takeout/Nothing") == []
+        assert "Takeout/Location History (Timeline)/Records.json" in archive
+        pd.testing.assert_frame_equal(
+            archive.fit_heart_rate_data(),
+            google_takeout.fit_heart_rate_data(google_takeout_zipped)
+        )
+        assert archive.list_myactivity_sections() == google_takeout.list_myactivity_sections(google_takeout_zipped)
+        # The methods are the readers themselves
+        assert archive.fit_read_data.__func__ is google_takeout.fit_read_data
+        assert list(inspect.signature(archive.fit_read_data).parameters)[0] == "data_filename"
+        assert archive.email_activity.__doc__ == google_takeout.email_activity.__doc__
+
+    # A full read opens the zip file once
+    opened = []
+    class CountingZipFile(zipfile.ZipFile):
+        def __init__(self, *args, **kwargs):
+            opened.append(args[0])
+            super().__init__(*args, **kwargs)
+    monkeypatch.setattr(google_takeout, "ZipFile", CountingZipFile)
+    google_takeout.fit_all_data(google_takeout_zipped, max_workers=1)
+    assert len(opened) == 1
+    google_takeout.fit_all_data(google_takeout_zipped)
+    assert len(opened) == 2
+    with google_takeout.TakeoutArchive(google_takeout_zipped) as archive:
+        archive.fit_all_data()
+        archive.fit_heart_rate_data()
+    assert len(opened) == 3
+
+
+def test_fit_expand_data_filename_pattern(tmp_path):
+    zip_filename = str(tmp_path / "takeout.zip")
+    with zipfile.ZipFile(zip_filename, "w") as zip_file:
+        for name in ["a+b.json", "a+b(1).json", "aab.json", "a+b_c.json"]:
+            zip_file.writestr("Takeout/Fit/All Data/" + name, "{}")
+    data = niimpy.reading.google_takeout.fit_expand_data_filename(zip_filename, "a+b.json")
+    assert data == ["Takeout/Fit/All Data/a+b.json", "Takeout/Fit/All Data/a+b(1).json"]
+
+
+def test_fit_data_source(google_takeout_zipped, monkeypatch):
+    google_takeout = niimpy.reading.google_takeout
+    with google_takeout.TakeoutArchive(google_takeout_zipped) as archive:
+        for filename in archive.members("Takeout/Fit/All Data"):
+            with archive.open(filename) as file:
+                expected = json.load(file)["Data Source"]
+            assert archive.fit_data_source(filename) == expected
+
+        expected = archive.fit_list_data()
+        # The data sources are cached in the archive
+        monkeypatch.setattr(archive, "open", None)
+        pd.testing.assert_frame_equal(archive.fit_list_data(), expected)
+
+    assert google_takeout._scan_fit_data_source(io.BytesIO(b'{"Data Points": [{"Data Source": "x"}]}')) is None
+
+
+def test_fit_read_data_parallel(google_takeout_zipped, monkeypatch):
+    google_takeout = niimpy.reading.google_takeout
+    with google_takeout.TakeoutArchive(google_takeout_zipped) as archive:
+        filenames = archive.fit_list_data()["filename"]
+        expected = archive.fit_read_data(filenames, max_workers=1)
+
+    # Worker threads share the open zip file
+    opened = []
+    class CountingZipFile(zipfile.ZipFile):
+        def __init__(self, *args, **kwargs):
+            opened.append(args[0])
+            super().__init__(*args, **kwargs)
+    with monkeypatch.context() as m:
+        m.setattr(google_takeout, "ZipFile", CountingZipFile)
+        data = google_takeout.fit_read_data(google_takeout_zipped, filenames, max_workers=4, processes=False)
+    assert len(opened) == 1
+    pd.testing.assert_frame_equal(data, expected)
+    assert data["measurement_index"].max() + 1 == len(data.drop_duplicates("measurement_index"))
+    # Zip files on disk are decoded in worker processes by default
+    submitted = []
+    class RecordingPool(google_takeout.ProcessPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            submitted.append(fn)
+            return super().submit(fn, *args, **kwargs)
+    with monkeypatch.context() as m:
+        m.setattr(google_takeout, "ProcessPoolExecutor", RecordingPool)
+        data = google_takeout.fit_read_data(google_takeout_zipped, filenames, max_workers=2)
+    assert submitted and all(fn is google_takeout._fit_read_data_file_worker for fn in submitted)
+    pd.testing.assert_frame_equal(data, expected)
+
+    # No matching files
+    data = google_takeout.fit_read_data(google_takeout_zipped, [])
+    assert data.empty
+    assert {"measurement_index", "value", "modified_time"} <= set(data.columns)
+    assert google_takeout.fit_read_data(google_takeout_zipped, "nothing.json").empty
+
+
 def test_fit_sessions(google_takeout_zipped):
     data = niimpy.reading.google_takeout.fit_sessions(
         google_takeout_zipped
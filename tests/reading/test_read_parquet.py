@@ -0,0 +1,41 @@
+import pandas as pd
+
+import niimpy
+from niimpy import config
+
+TZ = 'Europe/Helsinki'
+
+
+def test_parquet_roundtrip(tmp_path):
+    data = niimpy.read_csv(config.MULTIUSER_AWARE_SCREEN_PATH, tz=TZ, categorical_ids=True)
+    filename = str(tmp_path / 'screen.parquet')
+    niimpy.write_parquet(data, filename, row_group_size=50)
+    data2 = niimpy.read_parquet(filename)
+    pd.testing.assert_frame_equal(data2, data.sort_index(kind='stable'))
+    assert str(data2.index.tz) == TZ
+
+    data2 = niimpy.read_parquet(filename, columns=['screen_status'],
+                                start='2019-08-10', end='2019-08-20')
+    assert list(data2.columns) == ['user', 'device', 'screen_status']
+    expected = data[(data.index >= '2019-08-10') & (data.index < '2019-08-20')]
+    assert len(data2) == len(expected)
+
+
+def test_parquet_partitioned(tmp_path):
+    data = niimpy.read_csv(config.MULTIUSER_AWARE_SCREEN_PATH, tz=TZ)
+    path = str(tmp_path / 'screen')
+    niimpy.write_parquet(data, path, partition_by=['user', 'date'])
+    assert (tmp_path / 'screen' / 'user=jd9INuQ5BBlW' / 'date=2020-01-09').is_dir()
+
+    data2 = niimpy.read_parquet(path)
+    assert list(data2.columns) == list(data.columns)
+    assert len(data2) == len(data)
+    assert data2['user'].dtype == 'category'
+
+    data2 = niimpy.read_parquet(path, users=['iGyXetHE3S8u'], start='2019-08-10', end=1566000000,
+                                tz='UTC')
+    expected = data[(data['user'] == 'iGyXetHE3S8u') & (data.index >= '2019-08-10')
+                    & (data['time'] < 1566000000)]
+    assert len(data2) == len(expected) > 0
+    assert (data2['time'].values == expected['time'].values).all()
+    assert str(data2.index.tz) == 'UTC'
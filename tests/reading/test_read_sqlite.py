@@ -1,5 +1,10 @@
+import pandas as pd
+import pytest
+import shutil
+
 import niimpy
 from niimpy.reading import csv
+from niimpy.reading import util
 from niimpy.preprocessing import sampledata
 
 TZ = 'Europe/Helsinki'
@@ -9,3 +14,55 @@ def test_read_sqlite():
 
 def test_read_sqlite_tables():
     assert niimpy.read_sqlite_tables(sampledata.DATA) == {'AwareScreen'}
+
+def test_read_sqlite_chunksize():
+    data = niimpy.read_sqlite(sampledata.DATA, table='AwareScreen', tz=TZ)
+    chunks = list(niimpy.read_sqlite(sampledata.DATA, table='AwareScreen', tz=TZ, chunksize=100))
+    assert len(chunks) == 12
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    combined = pd.concat(chunks)
+    assert len(combined) == len(data)
+    assert combined.index.is_monotonic_increasing
+    assert (combined['time'].values == data.sort_values('time')['time'].values).all()
+
+def test_read_sqlite_columns_dtypes():
+    data = niimpy.read_sqlite(sampledata.MULTIUSER, table='AwareBattery', tz=TZ,
+                              columns=['user', 'battery_level', 'battery_status'],
+                              dtypes=util.AWARE_DTYPES)
+    assert list(data.columns) == ['time', 'user', 'battery_level', 'battery_status', 'datetime']
+    assert data['user'].dtype == 'category'
+    assert data['battery_level'].dtype == 'float32'
+    assert data['battery_status'].dtype == 'Int8'
+    assert isinstance(data.index, pd.DatetimeIndex)
+    full = niimpy.read_sqlite(sampledata.MULTIUSER, table='AwareBattery', tz=TZ)
+    assert (data['battery_level'] == full['battery_level'].astype(float)).all()
+
+    chunks = list(niimpy.read_sqlite(sampledata.MULTIUSER, table='AwareBattery', tz=TZ, chunksize=100,
+                                     columns='battery_level', dtypes=util.AWARE_DTYPES))
+    assert list(chunks[0].columns) == ['time', 'battery_level', 'datetime']
+    assert chunks[0]['battery_level'].dtype == 'float32'
+
+def test_read_sqlite_many(tmp_path):
+    for name in ['user1', 'user2', 'user3']:
+        shutil.copy(sampledata.DATA, tmp_path / (name+'.sqlite3'))
+    single = niimpy.read_sqlite(sampledata.DATA, table='AwareScreen', tz=TZ)
+
+    data = niimpy.read_sqlite_many(str(tmp_path / '*.sqlite3'), 'AwareScreen', tz=TZ,
+                                   add_user=niimpy.reading.sqlite.FILENAME,
+                                   add_group={'user1': 'control', 'user2': 'control', 'user3': 'patient'})
+    assert len(data) == 3 * len(single)
+    assert list(data['user'].unique()) == ['user1', 'user2', 'user3']
+    assert (data.groupby('user', observed=True)['group'].first() == ['control', 'control', 'patient']).all()
+    assert isinstance(data['user'].dtype, pd.CategoricalDtype)
+    assert list(data['group'].cat.categories) == ['control', 'patient']
+    assert isinstance(data.index, pd.DatetimeIndex)
+
+    with pytest.raises(KeyError, match='user3'):
+        niimpy.read_sqlite_many(str(tmp_path / '*.sqlite3'), 'AwareScreen', tz=TZ,
+                                add_group={'user1': 'control', 'user2': 'control'})
+
+    data = niimpy.read_sqlite_many([str(tmp_path / 'user2.sqlite3')], 'AwareScreen', tz=TZ,
+                                   add_user=lambda filename: 'u', processes=True, max_workers=1,
+                                   start=pd.Timestamp('2018-07-11', tz=TZ), end=pd.Timestamp('2018-07-12', tz=TZ))
+    assert len(data) == 163
+    assert (data['user'] == 'u').all()